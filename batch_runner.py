@@ -0,0 +1,172 @@
+# batch_runner.py
+#
+# Rielaborazione offline di un file JSONL direttamente su ai_core, senza passare dallo
+# strato HTTP (niente autenticazione, piani o quote). Ogni riga del file di input è un
+# record del tipo:
+#
+#   {"module": "validator", "profile_name": "Generico", "text": "...", "ctov": {...}}
+#
+# dove "module" è uno tra validator, interpreter, compliance, strategist e "ctov" è
+# facoltativo (usato solo dal Validator). I risultati vengono scritti nel file di output
+# man mano che arrivano, uno per riga, con il numero di riga del record di input.
+# Le righe completate vengono annotate nel file di checkpoint: rilanciando lo stesso
+# comando dopo un'interruzione, i record già elaborati vengono saltati.
+#
+# Uso:
+#   python batch_runner.py input.jsonl output.jsonl --concurrency 8
+
+import argparse
+import asyncio
+import json
+import os
+import time
+
+import ai_core
+
+
+async def _run_validator(record: dict, args) -> str:
+    return await ai_core.normalize_text(record["text"], profile_name=record["profile_name"], model_name=args.validator_model, ctov_data=record.get("ctov"))
+
+async def _run_interpreter(record: dict, args) -> str:
+    return await ai_core.interpret_text(record["text"], profile_name=record["profile_name"], model_name=args.interpreter_model)
+
+async def _run_compliance(record: dict, args) -> str:
+    return await ai_core.check_compliance(record["text"], profile_name=record["profile_name"])
+
+async def _run_strategist(record: dict, args) -> str:
+    return await ai_core.generate_strategy(record["text"], profile_name=record["profile_name"])
+
+MODULE_RUNNERS = {
+    "validator": _run_validator,
+    "interpreter": _run_interpreter,
+    "compliance": _run_compliance,
+    "strategist": _run_strategist,
+}
+
+
+def load_checkpoint(path: str) -> set:
+    if not os.path.exists(path):
+        return set()
+    with open(path, "r", encoding="utf-8") as f:
+        return {int(line) for line in f if line.strip()}
+
+def percentile(sorted_values: list, fraction: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, round(fraction * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+class BatchRunner:
+    def __init__(self, args):
+        self.args = args
+        self.checkpoint_path = args.checkpoint or f"{args.output}.checkpoint"
+        self.completed_lines = load_checkpoint(self.checkpoint_path)
+        self.latencies = []
+        self.succeeded = 0
+        self.failed = 0
+        self.skipped = 0
+
+    async def process(self, line_number: int, record: dict) -> dict:
+        start = time.monotonic()
+        try:
+            runner = MODULE_RUNNERS.get(record.get("module"))
+            if runner is None:
+                raise ValueError(f"Modulo sconosciuto: {record.get('module')!r}")
+            output_text = await runner(record, self.args)
+            result = {"line": line_number, "status": "ok", "result": output_text.strip()}
+        except Exception as e:
+            result = {"line": line_number, "status": "error", "error": str(e)}
+        result["latency_ms"] = round((time.monotonic() - start) * 1000, 1)
+        self.latencies.append(result["latency_ms"])
+        return result
+
+    def write_result(self, result: dict, output_file, checkpoint_file):
+        # Prima il risultato, poi il checkpoint: una riga annotata nel checkpoint è
+        # sempre già presente nell'output.
+        output_file.write(json.dumps(result, ensure_ascii=False) + "\n")
+        output_file.flush()
+        checkpoint_file.write(f"{result['line']}\n")
+        checkpoint_file.flush()
+        if result["status"] == "ok":
+            self.succeeded += 1
+        else:
+            self.failed += 1
+
+    async def run(self):
+        semaphore = asyncio.Semaphore(self.args.concurrency)
+        pending = set()
+
+        with open(self.args.input, "r", encoding="utf-8") as input_file, \
+             open(self.args.output, "a", encoding="utf-8") as output_file, \
+             open(self.checkpoint_path, "a", encoding="utf-8") as checkpoint_file:
+
+            async def run_one(line_number: int, record: dict):
+                try:
+                    result = await self.process(line_number, record)
+                    self.write_result(result, output_file, checkpoint_file)
+                finally:
+                    semaphore.release()
+
+            for line_number, line in enumerate(input_file, start=1):
+                if not line.strip():
+                    continue
+                if line_number in self.completed_lines:
+                    self.skipped += 1
+                    continue
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError as e:
+                    self.write_result({"line": line_number, "status": "error", "error": f"JSON non valido: {e}"}, output_file, checkpoint_file)
+                    continue
+
+                # La lettura dell'input si ferma finché non si libera uno slot, così in
+                # memoria ci sono al massimo `concurrency` record alla volta.
+                await semaphore.acquire()
+                task = asyncio.create_task(run_one(line_number, record))
+                pending.add(task)
+                task.add_done_callback(pending.discard)
+
+            if pending:
+                await asyncio.gather(*pending)
+
+    def print_report(self, elapsed: float):
+        processed = self.succeeded + self.failed
+        latencies = sorted(self.latencies)
+        print("--- Riepilogo batch ---")
+        print(f"  Record elaborati: {processed} (ok: {self.succeeded}, errori: {self.failed}, saltati da checkpoint: {self.skipped})")
+        print(f"  Tempo totale: {elapsed:.1f}s")
+        print(f"  Throughput: {processed / elapsed if elapsed > 0 else 0:.2f} record/s")
+        if latencies:
+            print(f"  Latenza p50: {percentile(latencies, 0.50):.0f} ms")
+            print(f"  Latenza p90: {percentile(latencies, 0.90):.0f} ms")
+            print(f"  Latenza p99: {percentile(latencies, 0.99):.0f} ms")
+            print(f"  Latenza max: {latencies[-1]:.0f} ms")
+        print("-----------------------")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Elabora un file JSONL di testi tramite ai_core.")
+    parser.add_argument("input", help="File JSONL di input ({module, profile_name, text, ctov} per riga).")
+    parser.add_argument("output", help="File JSONL di output (in append, una riga per record).")
+    parser.add_argument("--concurrency", type=int, default=8, help="Numero massimo di chiamate AI in parallelo.")
+    parser.add_argument("--checkpoint", default=None, help="File di checkpoint (default: <output>.checkpoint).")
+    parser.add_argument("--validator-model", default=ai_core.VALIDATOR_MODEL_NAME, help="Modello usato per i record del Validator.")
+    parser.add_argument("--interpreter-model", default=ai_core.INTERPRETER_MODEL_NAME, help="Modello usato per i record dell'Interpreter.")
+    args = parser.parse_args()
+    if args.concurrency < 1:
+        parser.error("--concurrency deve essere almeno 1")
+    return args
+
+async def main():
+    args = parse_args()
+    runner = BatchRunner(args)
+    await ai_core.warm_up_models()
+    start = time.monotonic()
+    try:
+        await runner.run()
+    finally:
+        runner.print_report(time.monotonic() - start)
+
+if __name__ == "__main__":
+    asyncio.run(main())
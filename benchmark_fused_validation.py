@@ -0,0 +1,89 @@
+# benchmark_fused_validation.py
+#
+# Confronta, sugli stessi testi, il Validator a due chiamate (normalize_text seguito da
+# get_quality_score) con la modalità "riscrivi e valuta" in un'unica chiamata
+# (normalize_and_score): latenza end-to-end e concordanza dei punteggi di qualità.
+# La cache delle risposte viene disattivata, così ogni misura è una chiamata reale.
+#
+# Uso:
+#   python benchmark_fused_validation.py testi.jsonl --profile Generico
+#
+# Il file di input ha un record per riga: {"text": "..."} (eventualmente con "profile_name").
+# Senza --profile vengono usati i profili con "fused_quality_check" in PROMPT_TEMPLATES;
+# di default non ce n'è nessuno, quindi un profilo da valutare prima di attivare il flag
+# va indicato con --profile (o con "profile_name" nel record).
+
+import argparse
+import asyncio
+import json
+import time
+
+import ai_core
+from batch_runner import percentile
+
+
+async def run_two_calls(text: str, profile_name: str, model_name: str):
+    start = time.monotonic()
+    normalized_text = await ai_core.normalize_text(text, profile_name=profile_name, model_name=model_name)
+    report = await ai_core.get_quality_score(original_text=text, normalized_text=normalized_text, profile_name=profile_name, model_name=model_name)
+    return time.monotonic() - start, report.get("human_quality_score")
+
+async def run_fused(text: str, profile_name: str, model_name: str):
+    start = time.monotonic()
+    result = await ai_core.normalize_and_score(text, profile_name=profile_name, model_name=model_name)
+    return time.monotonic() - start, result["quality_report"].get("human_quality_score")
+
+def load_texts(path: str) -> list:
+    with open(path, "r", encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def print_latencies(label: str, latencies: list):
+    ordered = sorted(latencies)
+    if not ordered:
+        print(f"  {label}: nessuna misura valida")
+        return
+    print(f"  {label}: p50 {percentile(ordered, 0.50) * 1000:.0f} ms, p90 {percentile(ordered, 0.90) * 1000:.0f} ms, media {sum(ordered) / len(ordered) * 1000:.0f} ms")
+
+async def main():
+    parser = argparse.ArgumentParser(description="Benchmark Validator: due chiamate contro riscrivi-e-valuta.")
+    parser.add_argument("input", help="File JSONL con un campo 'text' per riga.")
+    parser.add_argument("--profile", default=None, help="Profilo Validator da usare per tutti i testi.")
+    parser.add_argument("--model", default=ai_core.VALIDATOR_MODEL_NAME, help="Modello da usare per entrambe le modalità.")
+    args = parser.parse_args()
+
+    ai_core.RESPONSE_CACHE_ENABLED = False
+    await ai_core.warm_up_models()
+
+    fused_profiles = [name for name in ai_core.PROMPT_TEMPLATES if ai_core.uses_fused_quality_check(name)]
+    records = load_texts(args.input)
+    two_call_latencies, fused_latencies, score_differences = [], [], []
+    errors = 0
+
+    for index, record in enumerate(records):
+        profile_name = args.profile or record.get("profile_name")
+        profile_names = [profile_name] if profile_name else fused_profiles
+        for profile_name in profile_names:
+            try:
+                two_call_latency, two_call_score = await run_two_calls(record["text"], profile_name, args.model)
+                fused_latency, fused_score = await run_fused(record["text"], profile_name, args.model)
+            except Exception as e:
+                errors += 1
+                print(f"!!! Record {index} ({profile_name}): {e}")
+                continue
+            two_call_latencies.append(two_call_latency)
+            fused_latencies.append(fused_latency)
+            if two_call_score is not None and fused_score is not None:
+                score_differences.append(abs(two_call_score - fused_score))
+
+    print("--- Benchmark Validator: due chiamate vs riscrivi-e-valuta ---")
+    print(f"  Misure: {len(two_call_latencies)} (errori: {errors})")
+    print_latencies("Due chiamate", two_call_latencies)
+    print_latencies("Chiamata unica", fused_latencies)
+    if score_differences:
+        print(f"  Differenza media punteggi: {sum(score_differences) / len(score_differences):.1f} punti")
+        print(f"  Punteggi entro 5 punti: {sum(1 for d in score_differences if d <= 5) / len(score_differences):.0%}")
+        print(f"  Punteggi entro 10 punti: {sum(1 for d in score_differences if d <= 10) / len(score_differences):.0%}")
+    print("-------------------------------------------------------------")
+
+if __name__ == "__main__":
+    asyncio.run(main())
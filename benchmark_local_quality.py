@@ -0,0 +1,88 @@
+# benchmark_local_quality.py
+#
+# Calibrazione del pre-scoring locale del Validator: per ogni testo confronta la stima
+# locale (local_quality_signals) con il punteggio di get_quality_score e mostra, per
+# diverse soglie LOCAL_QUALITY_HIGH / LOCAL_QUALITY_LOW, quante chiamate LLM si
+# risparmierebbero e quanto la stima locale si discosta dal punteggio dell'LLM.
+# La cache delle risposte viene disattivata, così ogni misura è una chiamata reale.
+#
+# Uso:
+#   python benchmark_local_quality.py testi.jsonl --profile Generico
+#
+# Il file di input ha un record per riga: {"text": "..."} (eventualmente con
+# "profile_name" e "normalized_text"; senza "normalized_text" il testo viene prima
+# riscritto con normalize_text).
+
+import argparse
+import asyncio
+import json
+
+import ai_core
+
+HIGH_THRESHOLDS = range(80, 100, 2)
+LOW_THRESHOLDS = range(20, 55, 5)
+# Scarto oltre il quale una stima locale accettata conta come errore grave.
+SEVERE_GAP = 15
+
+
+def load_texts(path: str) -> list:
+    with open(path, "r", encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+async def measure(record: dict, profile_name: str, model_name: str):
+    normalized_text = record.get("normalized_text")
+    if normalized_text is None:
+        normalized_text = await ai_core.normalize_text(record["text"], profile_name=profile_name, model_name=model_name)
+    report = await ai_core.get_quality_score(original_text=record["text"], normalized_text=normalized_text, profile_name=profile_name, model_name=model_name)
+    if "human_quality_score" not in report:
+        raise RuntimeError(report.get("error", "punteggio LLM mancante"))
+    return ai_core.local_quality_signals(record["text"], normalized_text), float(report["human_quality_score"])
+
+def print_thresholds(pairs: list):
+    total = len(pairs)
+    print("  Soglia alta (stima locale accettata se >= soglia, con rapporto di lunghezza e frasi nei limiti):")
+    for high in HIGH_THRESHOLDS:
+        accepted = [(s, llm) for s, llm in pairs if s["human_quality_score"] >= high and ai_core.local_score_is_confident(s, high=high, low=-1)]
+        print_row(f"    >= {high}", accepted, total, lambda s, llm: s["human_quality_score"] - llm > SEVERE_GAP)
+    print("  Soglia bassa (stima locale accettata se <= soglia):")
+    for low in LOW_THRESHOLDS:
+        accepted = [(s, llm) for s, llm in pairs if s["human_quality_score"] <= low]
+        print_row(f"    <= {low}", accepted, total, lambda s, llm: llm - s["human_quality_score"] > SEVERE_GAP)
+
+def print_row(label: str, accepted: list, total: int, is_severe):
+    if not accepted:
+        print(f"{label}: nessun testo")
+        return
+    mean_gap = sum(abs(s["human_quality_score"] - llm) for s, llm in accepted) / len(accepted)
+    severe = sum(1 for s, llm in accepted if is_severe(s, llm))
+    print(f"{label}: chiamate risparmiate {len(accepted) / total:.0%}, scarto medio {mean_gap:.1f} punti, scarti gravi (> {SEVERE_GAP} punti) {severe / len(accepted):.0%}")
+
+async def main():
+    parser = argparse.ArgumentParser(description="Calibrazione delle soglie del pre-scoring locale del Validator.")
+    parser.add_argument("input", help="File JSONL con un campo 'text' per riga.")
+    parser.add_argument("--profile", default="Generico", help="Profilo Validator usato per i record senza 'profile_name'.")
+    parser.add_argument("--model", default=ai_core.VALIDATOR_MODEL_NAME, help="Modello usato per riscrittura e quality score.")
+    args = parser.parse_args()
+
+    ai_core.RESPONSE_CACHE_ENABLED = False
+    await ai_core.warm_up_models()
+
+    pairs = []
+    errors = 0
+    for index, record in enumerate(load_texts(args.input)):
+        profile_name = record.get("profile_name") or args.profile
+        try:
+            pairs.append(await measure(record, profile_name, args.model))
+        except Exception as e:
+            errors += 1
+            print(f"!!! Record {index} ({profile_name}): {e}")
+
+    print("--- Calibrazione pre-scoring locale vs quality score LLM ---")
+    print(f"  Misure: {len(pairs)} (errori: {errors})")
+    if pairs:
+        print_thresholds(pairs)
+        print(f"  Soglie attuali: LOCAL_QUALITY_HIGH={ai_core.LOCAL_QUALITY_HIGH}, LOCAL_QUALITY_LOW={ai_core.LOCAL_QUALITY_LOW}")
+    print("------------------------------------------------------------")
+
+if __name__ == "__main__":
+    asyncio.run(main())
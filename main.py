@@ -1,24 +1,32 @@
 import logging # <-- AGGIUNGI QUESTA RIGA
+import asyncio
+import hashlib
+import hmac
+import json
 import time
-import requests
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+import httpx
 import os
 import uvicorn
-import redis
+import redis.asyncio as aioredis
 from fastapi import Request, FastAPI, HTTPException, status, Response
 from pydantic import BaseModel, Field
-from datetime import date
-from fastapi import Header
+from datetime import date, datetime, timedelta
+from fastapi import Header, Depends
 from dotenv import load_dotenv
 load_dotenv()
 from svix.webhooks import Webhook, WebhookVerificationError # <-- MODIFICA QUESTA RIG
 from supabase import create_client, Client
 # --- NUOVE IMPORTAZIONI PER IL CORS ---
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from slowapi import Limiter, _rate_limit_exceeded_handler
 from slowapi.util import get_remote_address
 from slowapi.errors import RateLimitExceeded
 import ai_core
-from typing import List, Optional
+from typing import Annotated, List, Optional
 # --- Aggiungi l'importazione per la verifica dei JWT RS256 ---
 from jose import jwt, jwk # pip install python-jose
 
@@ -29,6 +37,7 @@ PLANS = {
     "free": {
         "shared_limit": 5,
         "max_input_length": 1500,
+        "max_prompt_tokens": 2500,
         "validator": {
             "allowed_profiles": ["Generico", "L'Umanizzatore", "Social Media Manager B2B", "Ottimizzatore Email di Vendita"],
             "quality_check": False
@@ -53,6 +62,7 @@ PLANS = {
     "starter": {
         "shared_limit": 20,
         "max_input_length": 15000,
+        "max_prompt_tokens": 9000,
         "validator": {
             "allowed_profiles": [
                 # Profili Free
@@ -62,7 +72,8 @@ PLANS = {
                 "Scrittore Testi per Landing Page", "Redattore di Annunci di Lavoro", "Scrittore di Proposte Commerciali",
                 "Redattore di Sezioni di Business Plan", "Comunicatore di Crisi PR"
             ],
-            "quality_check": True
+            "quality_check": True,
+            "full_quality_reasoning": False # Stima locale quando è netta (vedi ai_core.score_quality)
         },
         "interpreter": {
             "allowed_profiles": [
@@ -89,9 +100,11 @@ PLANS = {
     "pro": {
         "shared_limit": 150,
         "max_input_length": 100000,
+        "max_prompt_tokens": 40000,
         "validator": {
             "allowed_profiles": "all",
-            "quality_check": True
+            "quality_check": True,
+            "full_quality_reasoning": False
         },
         "interpreter": {
             "allowed_profiles": "all",
@@ -113,7 +126,8 @@ PLANS = {
     "business": { # NUOVO PIANO
         "shared_limit": -1, # Illimitato o gestito a livello di team
         "max_input_length": None,
-        "validator": { "allowed_profiles": "all", "quality_check": True },
+        "max_prompt_tokens": None,
+        "validator": { "allowed_profiles": "all", "quality_check": True, "full_quality_reasoning": True },
         "interpreter": { "allowed_profiles": "all", "quality_check": True },
         "compliance_checkr": { "enabled": True, "allowed_profiles": "all" },
         "strategist": { "enabled": True, "allowed_profiles": "all" },
@@ -122,7 +136,8 @@ PLANS = {
     "admin": {
         "shared_limit": -1,
         "max_input_length": None,
-        "validator": { "allowed_profiles": "all", "quality_check": True },
+        "max_prompt_tokens": None,
+        "validator": { "allowed_profiles": "all", "quality_check": True, "full_quality_reasoning": True },
         "interpreter": { "allowed_profiles": "all", "quality_check": True },
         "compliance_checkr": { "enabled": True, "allowed_profiles": "all" },
         "strategist": { "enabled": True, "allowed_profiles": "all" },
@@ -165,10 +180,169 @@ if not GOOGLE_API_KEY:
 # Inizializzazione Supabase con le variabili verificate
 supabase: Client = create_client(SUPABASE_URL, SUPABASE_SERVICE_KEY)
 
+# --- I/O NON BLOCCANTE ---
+# supabase-py è sincrono: le query girano in un pool di thread dedicato e limitato,
+# così una query lenta non blocca l'event loop (e gli stream Gemini in corso).
+DB_EXECUTOR_MAX_WORKERS = int(os.getenv("DB_EXECUTOR_MAX_WORKERS", 32))
+db_executor = ThreadPoolExecutor(max_workers=DB_EXECUTOR_MAX_WORKERS, thread_name_prefix="supabase")
+
+async def run_query(query):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(db_executor, query.execute)
+
+# Client HTTP asincrono condiviso (keep-alive) per le chiamate in uscita, es. JWKS di Clerk.
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", 100))
+http_client = httpx.AsyncClient(
+    timeout=httpx.Timeout(10.0),
+    limits=httpx.Limits(max_connections=HTTP_MAX_CONNECTIONS, max_keepalive_connections=20)
+)
+
 CLERK_JWKS_URL = os.getenv("CLERK_JWKS_URL")
 if not CLERK_JWKS_URL:
     raise ValueError("CLERK_JWKS_URL non trovata nel file .env")
 
+# --- CACHE DELLE CHIAVI PUBBLICHE CLERK (JWKS) ---
+JWKS_REFRESH_INTERVAL_SECONDS = int(os.getenv("JWKS_REFRESH_INTERVAL_SECONDS", 3600))
+JWKS_MIN_FORCED_REFRESH_SECONDS = int(os.getenv("JWKS_MIN_FORCED_REFRESH_SECONDS", 30))
+JWKS_FETCH_TIMEOUT_SECONDS = float(os.getenv("JWKS_FETCH_TIMEOUT_SECONDS", 5))
+
+JWT_DECODE_OPTIONS = {
+    "verify_signature": True,
+    "verify_aud": False,
+    "verify_iss": False,
+    "leeway": 5
+}
+
+class JWKSKeyStore:
+    """
+    Archivio process-wide delle chiavi pubbliche Clerk, già costruite e indicizzate per `kid`.
+    Viene aggiornato in background ogni `refresh_interval` secondi; un `kid` sconosciuto forza
+    un refresh immediato (al massimo uno ogni `min_forced_refresh` secondi). Se Clerk non
+    risponde si continua a usare l'ultimo set di chiavi valido.
+    """
+    def __init__(self, jwks_url: str, refresh_interval: int, min_forced_refresh: int):
+        self.jwks_url = jwks_url
+        self.refresh_interval = refresh_interval
+        self.min_forced_refresh = min_forced_refresh
+        self._keys = {}
+        self._last_attempt = 0.0
+        self._lock = asyncio.Lock()
+
+    async def _fetch_jwks(self) -> dict:
+        jwks_response = await http_client.get(self.jwks_url, timeout=JWKS_FETCH_TIMEOUT_SECONDS)
+        jwks_response.raise_for_status()
+        return jwks_response.json()
+
+    async def _refresh_locked(self):
+        self._last_attempt = time.monotonic()
+        jwks_data = await self._fetch_jwks()
+        keys = {}
+        for key_data in jwks_data.get("keys", []):
+            if "kid" not in key_data:
+                continue
+            # Una chiave non supportata o malformata non deve invalidare le altre.
+            try:
+                keys[key_data["kid"]] = jwk.construct(key_data)
+            except Exception as e:
+                logging.warning(f"Chiave JWKS {key_data['kid']} ignorata: {e}")
+        if not keys:
+            raise Exception("Nessuna chiave pubblica presente nel JWKS di Clerk.")
+        self._keys = keys
+        logging.info(f"JWKS Clerk aggiornato: {len(keys)} chiavi disponibili.")
+
+    async def refresh(self):
+        async with self._lock:
+            await self._refresh_locked()
+
+    async def get_key(self, kid: str):
+        public_key = self._keys.get(kid)
+        if public_key is not None:
+            return public_key
+        # Kid sconosciuto: probabile rotazione delle chiavi, forziamo un refresh.
+        async with self._lock:
+            public_key = self._keys.get(kid)
+            if public_key is None and time.monotonic() - self._last_attempt >= self.min_forced_refresh:
+                await self._refresh_locked()
+                public_key = self._keys.get(kid)
+        return public_key
+
+    async def run_background_refresh(self):
+        while True:
+            await asyncio.sleep(self.refresh_interval)
+            try:
+                await self.refresh()
+            except Exception as e:
+                logging.warning(f"Refresh JWKS fallito, continuo con le chiavi in cache: {e}")
+
+jwks_key_store = JWKSKeyStore(CLERK_JWKS_URL, JWKS_REFRESH_INTERVAL_SECONDS, JWKS_MIN_FORCED_REFRESH_SECONDS)
+
+# --- CACHE DEI TOKEN GIÀ VERIFICATI ---
+VERIFIED_TOKEN_CACHE_SIZE = int(os.getenv("VERIFIED_TOKEN_CACHE_SIZE", 10000))
+
+class VerifiedTokenCache:
+    """
+    LRU limitata dei claims già verificati, indicizzata per digest SHA-256 del token.
+    Ogni voce scade all'`exp` del JWT, quindi un token riutilizzato salta sia il parsing
+    dell'header sia la verifica RS256 finché è valido.
+    """
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _digest(token: str) -> str:
+        return hashlib.sha256(token.encode()).hexdigest()
+
+    def get(self, token: str) -> Optional[dict]:
+        digest = self._digest(token)
+        entry = self._entries.get(digest)
+        if entry is None:
+            self.misses += 1
+            return None
+        expires_at, claims = entry
+        if time.time() >= expires_at:
+            del self._entries[digest]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(digest)
+        self.hits += 1
+        return claims
+
+    def put(self, token: str, claims: dict):
+        expires_at = claims.get("exp")
+        if not isinstance(expires_at, (int, float)) or self.max_size <= 0:
+            return
+        digest = self._digest(token)
+        self._entries[digest] = (expires_at, claims)
+        self._entries.move_to_end(digest)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0
+        }
+
+verified_token_cache = VerifiedTokenCache(VERIFIED_TOKEN_CACHE_SIZE)
+
+async def verify_clerk_token(clerk_jwt_token_string: str) -> dict:
+    cached_claims = verified_token_cache.get(clerk_jwt_token_string)
+    if cached_claims is not None:
+        return cached_claims
+    header = jwt.get_unverified_header(clerk_jwt_token_string)
+    public_key = await jwks_key_store.get_key(header.get("kid"))
+    if not public_key: raise Exception("Chiave pubblica non trovata.")
+    decoded_token = jwt.decode(clerk_jwt_token_string, public_key, algorithms=["RS256"], options=JWT_DECODE_OPTIONS)
+    verified_token_cache.put(clerk_jwt_token_string, decoded_token)
+    return decoded_token
+
 # --- Pydantic Models ---
 class TextInput(BaseModel):
     text: str = Field(..., min_length=10)
@@ -178,10 +352,12 @@ class TextInput(BaseModel):
 class QualityReport(BaseModel):
     reasoning: str
     human_quality_score: int
+    source: str = "llm" # "llm" oppure "local" (stima locale, senza chiamata di quality score)
 
 class UsageInfo(BaseModel):
     count: int
     limit: int
+    estimated_tokens: Optional[int] = None # Stima locale dei token del prompt inviato al modello
 
 class CTOVProfileBase(BaseModel):
     name: str = Field(..., min_length=1, max_length=50)
@@ -227,8 +403,391 @@ class StrategyResponse(BaseModel):
     strategy_text: str
     usage: UsageInfo
 
+# --- Modelli per gli endpoint batch ---
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", 100))
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", 8))
+
+class BatchTextInput(BaseModel):
+    texts: List[Annotated[str, Field(min_length=10)]] = Field(..., min_length=1, max_length=BATCH_MAX_ITEMS)
+    profile_name: str = Field("Generico", description="Nome del profilo AI da utilizzare per tutti i testi del batch.")
+    ctov_profile_id: Optional[str] = None
+
+class BatchItemResult(BaseModel):
+    index: int
+    status: str # "ok" oppure "error"
+    result: Optional[str] = None
+    quality_report: Optional[QualityReport] = None
+    error: Optional[str] = None
+
+class BatchResponse(BaseModel):
+    results: List[BatchItemResult]
+    succeeded: int
+    failed: int
+    usage: UsageInfo
+
+# --- CACHE REDIS DEI PROFILI ---
+# Cache read-through delle righe di `profiles` (tier, ruolo, contatore d'uso). Se REDIS_URL
+# non è configurato, o Redis non risponde, si legge direttamente da Supabase.
+REDIS_URL = os.getenv("REDIS_URL")
+PROFILE_CACHE_TTL_SECONDS = int(os.getenv("PROFILE_CACHE_TTL_SECONDS", 60))
+redis_client = aioredis.from_url(REDIS_URL, decode_responses=True) if REDIS_URL else None
+profile_cache_stats = {"hits": 0, "misses": 0, "errors": 0}
+
+def _profile_cache_key(user_id: str) -> str:
+    return f"profile:{user_id}"
+
+async def cache_profile(profile: dict):
+    if redis_client is None or not profile.get('id'):
+        return
+    try:
+        await redis_client.set(_profile_cache_key(profile['id']), json.dumps(profile, default=str), ex=PROFILE_CACHE_TTL_SECONDS)
+    except Exception as e:
+        profile_cache_stats["errors"] += 1
+        logging.warning(f"Scrittura cache profilo fallita per {profile['id']}: {e}")
+
+async def invalidate_profile(user_id: str):
+    if redis_client is None:
+        return
+    try:
+        await redis_client.delete(_profile_cache_key(user_id))
+    except Exception as e:
+        profile_cache_stats["errors"] += 1
+        logging.warning(f"Invalidazione cache profilo fallita per {user_id}: {e}")
+
+async def load_profile(user_id: str) -> Optional[dict]:
+    if redis_client is not None:
+        try:
+            cached = await redis_client.get(_profile_cache_key(user_id))
+            if cached:
+                profile_cache_stats["hits"] += 1
+                return json.loads(cached)
+        except Exception as e:
+            profile_cache_stats["errors"] += 1
+            logging.warning(f"Lettura cache profilo fallita per {user_id}: {e}")
+        profile_cache_stats["misses"] += 1
+
+    profile_res = await run_query(supabase.table('profiles').select('*').eq('id', user_id))
+    if not profile_res.data:
+        return None
+    profile = profile_res.data[0]
+    await cache_profile(profile)
+    return profile
+
+async def update_profile(user_id: str, update_data: dict):
+    # Write-through: Supabase restituisce la riga aggiornata, che sostituisce quella in cache.
+    res = await run_query(supabase.table('profiles').update(update_data).eq('id', user_id))
+    if res.data:
+        await cache_profile(res.data[0])
+    else:
+        await invalidate_profile(user_id)
+    return res
+
+# --- CACHE DEI PROFILI CTOV ---
+# Le voci personalizzate di ogni utente (tutte le righe di `ctov_profiles`) vengono tenute
+# in memoria nel processo e in Redis, così /validate con ctov_profile_id non interroga il
+# database. Gli endpoint /ctov-profiles invalidano entrambe le copie dopo ogni scrittura;
+# la copia in memoria ha un TTL breve perché l'invalidazione raggiunge solo il processo
+# che ha gestito la scrittura. Le intestazioni di prompt derivate dal profilo sono
+# precompilate da ai_core.ctov_prompt per id e updated_at.
+CTOV_CACHE_TTL_SECONDS = int(os.getenv("CTOV_CACHE_TTL_SECONDS", 600))
+CTOV_LOCAL_CACHE_TTL_SECONDS = int(os.getenv("CTOV_LOCAL_CACHE_TTL_SECONDS", 30))
+CTOV_LOCAL_CACHE_MAX_USERS = int(os.getenv("CTOV_LOCAL_CACHE_MAX_USERS", 10000))
+_ctov_local_cache = OrderedDict() # user_id -> (scadenza, righe)
+ctov_cache_stats = {"local_hits": 0, "redis_hits": 0, "misses": 0, "errors": 0}
+
+def _ctov_cache_key(user_id: str) -> str:
+    return f"ctov_profiles:{user_id}"
+
+def _remember_ctov_profiles(user_id: str, rows: list):
+    _ctov_local_cache[user_id] = (time.monotonic() + CTOV_LOCAL_CACHE_TTL_SECONDS, rows)
+    _ctov_local_cache.move_to_end(user_id)
+    if len(_ctov_local_cache) > CTOV_LOCAL_CACHE_MAX_USERS:
+        _ctov_local_cache.popitem(last=False)
+
+async def load_ctov_profiles(user_id: str) -> list:
+    # Tutte le voci dell'utente, in ordine di creazione, con l'id già convertito in stringa.
+    entry = _ctov_local_cache.get(user_id)
+    if entry is not None and entry[0] > time.monotonic():
+        ctov_cache_stats["local_hits"] += 1
+        return entry[1]
+    if redis_client is not None:
+        try:
+            cached = await redis_client.get(_ctov_cache_key(user_id))
+            if cached:
+                ctov_cache_stats["redis_hits"] += 1
+                rows = json.loads(cached)
+                _remember_ctov_profiles(user_id, rows)
+                return rows
+        except Exception as e:
+            ctov_cache_stats["errors"] += 1
+            logging.warning(f"Lettura cache CTOV fallita per {user_id}: {e}")
+    ctov_cache_stats["misses"] += 1
+
+    res = await run_query(supabase.table('ctov_profiles').select('*').eq('user_id', user_id).order('created_at'))
+    rows = [{**row, 'id': str(row['id'])} for row in res.data or []]
+    _remember_ctov_profiles(user_id, rows)
+    if redis_client is not None:
+        try:
+            await redis_client.set(_ctov_cache_key(user_id), json.dumps(rows, default=str), ex=CTOV_CACHE_TTL_SECONDS)
+        except Exception as e:
+            ctov_cache_stats["errors"] += 1
+            logging.warning(f"Scrittura cache CTOV fallita per {user_id}: {e}")
+    return rows
+
+async def load_ctov_profile(user_id: str, profile_id: str) -> Optional[dict]:
+    return next((row for row in await load_ctov_profiles(user_id) if row['id'] == str(profile_id)), None)
+
+async def invalidate_ctov_profiles(user_id: str):
+    _ctov_local_cache.pop(user_id, None)
+    if redis_client is None:
+        return
+    try:
+        await redis_client.delete(_ctov_cache_key(user_id))
+    except Exception as e:
+        ctov_cache_stats["errors"] += 1
+        logging.warning(f"Invalidazione cache CTOV fallita per {user_id}: {e}")
+
+# Funzione helper da aggiungere per non ripetere il codice di autenticazione
+async def get_user_profile_from_token(authorization: str):
+    if not authorization or not authorization.startswith("Bearer "):
+        raise HTTPException(status_code=401, detail="Token di autenticazione mancante.")
+    
+    clerk_jwt_token_string = authorization.split(" ")[1]
+    user_id = None
+    try:
+        decoded_token = await verify_clerk_token(clerk_jwt_token_string)
+        user_id = decoded_token.get("sub")
+        if not user_id: raise Exception("ID utente non trovato.")
+    except Exception as e:
+        raise HTTPException(status_code=401, detail=f"Validazione token fallita: {str(e)}")
+
+    profile = await load_profile(user_id)
+    if not profile:
+        raise HTTPException(status_code=500, detail="Profilo utente non trovato.")
+    
+    return user_id, profile
+
+class AuthContext(BaseModel):
+    user_id: str
+    profile: dict
+    plan: dict
+    tier_name: Optional[str] = None
+    role: Optional[str] = None
+
+    @property
+    def display_tier(self) -> Optional[str]:
+        return self.tier_name if self.role != 'admin' else 'admin'
+
+# Dipendenza FastAPI: token e profilo vengono risolti una sola volta per richiesta
+# e il risultato è condiviso da tutti gli endpoint autenticati.
+async def get_auth_context(authorization: str = Header(None)) -> AuthContext:
+    user_id, profile = await get_user_profile_from_token(authorization)
+    user_tier_name = profile.get('subscription_tier', 'free')
+    user_role = profile.get('role', 'user')
+    plan = PLANS.get("admin") if user_role == 'admin' else PLANS.get(user_tier_name, PLANS["free"])
+    return AuthContext(user_id=user_id, profile=profile, plan=plan, tier_name=user_tier_name, role=user_role)
+
+# --- GESTIONE QUOTA GIORNALIERA ---
+# Con Redis il contatore giornaliero vive in una chiave per utente e per giorno
+# (`usage:{user_id}:{YYYY-MM-DD}`) che scade al cambio di data; l'incremento con verifica
+# del limite è un unico script Lua atomico, quindi richieste concorrenti su più istanze
+# non perdono incrementi. Supabase viene aggiornato in background solo per il reporting.
+# Senza Redis la stessa operazione è una singola RPC Postgres.
+# Il contatore di riferimento è uno solo per deployment: se Redis è configurato ma non
+# risponde la richiesta viene rifiutata con un 503, invece di contare su Postgres in
+# parallelo (i due contatori divergerebbero e la quota si potrebbe quasi raddoppiare).
+# La quota viene prenotata prima della chiamata AI e restituita se la chiamata fallisce:
+# una raffica di richieste parallele viene fermata prima di consumare capacità del modello.
+USAGE_KEY_GRACE_SECONDS = 3600
+USAGE_BACKEND_RETRY_AFTER_SECONDS = 5
+
+# KEYS[1] = chiave del contatore, ARGV[1] = limite, ARGV[2] = TTL, ARGV[3] = valore iniziale,
+# ARGV[4] = unità da prenotare
+USAGE_INCREMENT_LUA = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    redis.call('SET', KEYS[1], ARGV[3], 'EX', ARGV[2])
+end
+local current = tonumber(redis.call('GET', KEYS[1]))
+if current + tonumber(ARGV[4]) > tonumber(ARGV[1]) then
+    return -1
+end
+return redis.call('INCRBY', KEYS[1], ARGV[4])
+"""
+# KEYS[1] = chiave del contatore, ARGV[1] = unità da restituire (senza scendere sotto zero)
+USAGE_RELEASE_LUA = """
+local current = tonumber(redis.call('GET', KEYS[1]) or '0')
+local units = math.min(current, tonumber(ARGV[1]))
+if units > 0 then
+    return redis.call('DECRBY', KEYS[1], units)
+end
+return current
+"""
+usage_increment_script = redis_client.register_script(USAGE_INCREMENT_LUA) if redis_client is not None else None
+usage_release_script = redis_client.register_script(USAGE_RELEASE_LUA) if redis_client is not None else None
+
+# Riferimenti ai task in background, per evitare che vengano raccolti dal garbage collector.
+background_tasks = set()
+
+def run_in_background(coro):
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+def _usage_key(user_id: str, today: str) -> str:
+    return f"usage:{user_id}:{today}"
+
+def _seconds_until_tomorrow() -> int:
+    now = datetime.now()
+    tomorrow = datetime.combine(now.date() + timedelta(days=1), datetime.min.time())
+    return int((tomorrow - now).total_seconds()) + USAGE_KEY_GRACE_SECONDS
+
+def _profile_usage_today(profile: dict, today: str) -> int:
+    return profile.get('usage_count', 0) if profile.get('last_used_date') == today else 0
+
+async def _sync_usage_to_supabase(user_id: str, today: str, count: int):
+    try:
+        await update_profile(user_id, {'usage_count': count, 'last_used_date': today})
+    except Exception as e:
+        logging.warning(f"Sincronizzazione contatore d'uso su Supabase fallita per {user_id}: {e}")
+
+async def get_usage_count(auth: AuthContext) -> int:
+    today = str(date.today())
+    if redis_client is not None:
+        try:
+            value = await redis_client.get(_usage_key(auth.user_id, today))
+            if value is not None:
+                return int(value)
+        except Exception as e:
+            logging.warning(f"Lettura contatore d'uso da Redis fallita per {auth.user_id}: {e}")
+    return _profile_usage_today(auth.profile, today)
+
+# Contatori di processo delle prenotazioni: le chiamate AI fallite risultano come "released".
+usage_reservation_stats = {"reserved": 0, "committed": 0, "released": 0, "rejected": 0}
+
+class UsageReservation:
+    """
+    Unità di quota prenotate prima della chiamata AI. `commit()` le conferma dopo una
+    generazione riuscita; `release()` le restituisce se la chiamata fallisce, così un
+    errore del modello non viene mai conteggiato. Per i batch `settle()` conferma solo
+    le unità effettivamente usate e restituisce le altre.
+    """
+    def __init__(self, auth: AuthContext, count: int, today: str, backend: Optional[str], units: int = 1):
+        self.auth = auth
+        self.count = count
+        self.today = today
+        self.backend = backend
+        self.units = units
+        self._settled = False
+
+    async def commit(self):
+        if self._settled:
+            return
+        self._settled = True
+        usage_reservation_stats["committed"] += self.units
+        if self.backend == "redis":
+            run_in_background(_sync_usage_to_supabase(self.auth.user_id, self.today, self.count))
+
+    async def release(self):
+        if self._settled:
+            return
+        self._settled = True
+        await self._give_back(self.units)
+
+    def release_in_background(self):
+        # Per le interruzioni (CancelledError da client disconnesso o shutdown): il task
+        # della richiesta è già cancellato, quindi il rilascio gira in un task separato.
+        run_in_background(self.release())
+
+    async def settle(self, used_units: int):
+        if self._settled:
+            return
+        unused_units = self.units - used_units
+        if used_units == 0:
+            await self.release()
+            return
+        if unused_units > 0:
+            await self._give_back(unused_units)
+            self.units = used_units
+        await self.commit()
+
+    async def _give_back(self, units: int):
+        usage_reservation_stats["released"] += units
+        self.count -= units
+        try:
+            if self.backend == "redis":
+                await usage_release_script(keys=[_usage_key(self.auth.user_id, self.today)], args=[units])
+            elif self.backend == "postgres":
+                res = await run_query(supabase.rpc('release_usage_count', {
+                    'p_user_id': self.auth.user_id,
+                    'p_today': self.today,
+                    'p_units': units
+                }))
+                await cache_profile({**self.auth.profile, 'usage_count': int(res.data), 'last_used_date': self.today})
+        except Exception as e:
+            logging.warning(f"Rilascio della quota prenotata fallito per {self.auth.user_id}: {e}")
+
+async def reserve_usage(auth: AuthContext, units: int = 1) -> UsageReservation:
+    shared_limit = auth.plan["shared_limit"]
+    today = str(date.today())
+    if shared_limit == -1:
+        return UsageReservation(auth, auth.profile.get('usage_count', 0) + units, today, None, units)
+
+    if usage_increment_script is not None:
+        try:
+            new_count = await usage_increment_script(
+                keys=[_usage_key(auth.user_id, today)],
+                args=[shared_limit, _seconds_until_tomorrow(), _profile_usage_today(auth.profile, today), units]
+            )
+            backend = "redis"
+        except Exception as e:
+            logging.error(f"Prenotazione quota su Redis fallita per {auth.user_id}: {e}")
+            raise HTTPException(
+                status_code=503,
+                detail="Servizio temporaneamente non disponibile: impossibile verificare la quota giornaliera. Riprova tra qualche istante.",
+                headers={"Retry-After": str(USAGE_BACKEND_RETRY_AFTER_SECONDS)}
+            )
+    else:
+        # Senza Redis: un'unica RPC Postgres (supabase/migrations/*_increment_usage_count.sql)
+        # azzera al cambio di data, verifica il limite e incrementa in modo atomico.
+        res = await run_query(supabase.rpc('increment_usage_count', {
+            'p_user_id': auth.user_id,
+            'p_limit': shared_limit,
+            'p_today': today,
+            'p_units': units
+        }))
+        new_count = int(res.data)
+        backend = "postgres"
+        if new_count != -1:
+            await cache_profile({**auth.profile, 'usage_count': new_count, 'last_used_date': today})
+
+    if new_count == -1:
+        usage_reservation_stats["rejected"] += units
+        if units > 1:
+            raise HTTPException(status_code=429, detail=f"Il batch richiede {units} chiamate e supera il limite giornaliero condiviso di {shared_limit} chiamate.")
+        raise HTTPException(status_code=429, detail=f"Hai superato il limite giornaliero condiviso di {shared_limit} chiamate.")
+    usage_reservation_stats["reserved"] += units
+    return UsageReservation(auth, new_count, today, backend, units)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Precarica le chiavi JWKS: se Clerk non risponde all'avvio, il primo token le caricherà.
+    try:
+        await jwks_key_store.refresh()
+    except Exception as e:
+        logging.warning(f"Caricamento iniziale JWKS fallito: {e}")
+    jwks_refresh_task = asyncio.create_task(jwks_key_store.run_background_refresh())
+    ai_core.configure_response_cache(redis_client)
+    await ai_core.warm_up_models()
+    yield
+    jwks_refresh_task.cancel()
+    await http_client.aclose()
+    if redis_client is not None:
+        await redis_client.aclose()
+    db_executor.shutdown(wait=False)
+
 limiter = Limiter(key_func=get_remote_address)
-app = FastAPI(title="Text Validator API", version="1.0.0")
+app = FastAPI(title="Text Validator API", version="1.0.0", lifespan=lifespan)
 app.state.limiter = limiter
 app.add_exception_handler(RateLimitExceeded, _rate_limit_exceeded_handler)
 
@@ -249,23 +808,91 @@ app.add_middleware(
 )
 # --- FINE CONFIGURAZIONE CORS ---
 
+@app.middleware("http")
+async def retry_budget_per_request(request: Request, call_next):
+    # Un solo budget di retry per richiesta, condiviso da tutte le sue chiamate a Gemini.
+    with ai_core.request_retry_budget():
+        return await call_next(request)
+
 
 # ==============================================================================
-# === NUOVO ENDPOINT: STRATEGIST ===============================================
+# === CONTROLLI DI PIANO CONDIVISI =============================================
 # ==============================================================================
-@app.post("/strategist", response_model=StrategyResponse, tags=["Strategist"])
-@limiter.limit("5/minute")
-async def create_strategy(request: Request, payload: TextInput, authorization: str = Header(None)):
-    user_id, profile = await get_user_profile_from_token(authorization)
-    
-    # --- LOGICA DI GESTIONE PIANI PER STRATEGIST ---
-    user_tier_name = profile.get('subscription_tier', 'free')
-    user_role = profile.get('role', 'user')
-    plan = PLANS.get("admin") if user_role == 'admin' else PLANS.get(user_tier_name, PLANS["free"])
-    
+# Ogni modulo ha i suoi controlli (abilitazione, lunghezza input, profili consentiti);
+# sono raccolti qui perché li usano sia gli endpoint JSON sia le varianti in streaming.
+
+def _check_token_budget(auth: AuthContext, module: str, payload: TextInput, model_name: str, ctov_data: Optional[dict] = None) -> int:
+    # Budget sui token del prompt completo (template + testo + eventuale CTOV), stimati in locale.
+    estimated_tokens = ai_core.estimate_prompt_tokens(module, payload.profile_name, model_name, payload.text, ctov_data)
+    max_tokens = auth.plan.get("max_prompt_tokens")
+    if max_tokens is not None and estimated_tokens > max_tokens:
+        raise HTTPException(
+            status_code=413, # 413 Payload Too Large
+            detail=f"La richiesta (circa {estimated_tokens} token, istruzioni del profilo incluse) supera il limite di {max_tokens} token consentito per il tuo piano. Riduci il testo o esegui l'upgrade."
+        )
+    return estimated_tokens
+
+async def _prepare_validator_request(payload: TextInput, auth: AuthContext):
+    plan = auth.plan
+    # 0. Verifica lunghezza massima dell'input
+    max_length = plan.get("max_input_length")
+    if max_length is not None and len(payload.text) > max_length:
+        raise HTTPException(
+            status_code=413, # 413 Payload Too Large
+            detail=f"Il testo inserito ({len(payload.text)} caratteri) supera il limite di {max_length} caratteri consentito per il tuo piano. Esegui l'upgrade per analizzare documenti più lunghi."
+        )
+    validator_plan = plan["validator"]
+    model_to_use = ai_core.VALIDATOR_MODEL_NAME
+    # 1. Verifica profilo consentito
+    if validator_plan["allowed_profiles"] != "all" and payload.profile_name not in validator_plan["allowed_profiles"]:
+        raise HTTPException(status_code=403, detail=f"Il profilo Validator '{payload.profile_name}' non è incluso nel tuo piano.")
+
+    ctov_data = None
+    if payload.ctov_profile_id:
+        # Se viene richiesto un profilo CTOV, recuperalo (dalla cache delle voci dell'utente)
+        ctov_data = await load_ctov_profile(auth.user_id, payload.ctov_profile_id)
+        if not ctov_data:
+            raise HTTPException(status_code=404, detail="Profilo Custom Tone of Voice non trovato o non autorizzato.")
+    estimated_tokens = _check_token_budget(auth, "validator", payload, model_to_use, ctov_data)
+    return validator_plan, model_to_use, ctov_data, estimated_tokens
+
+def _prepare_interpreter_request(payload: TextInput, auth: AuthContext):
+    plan = auth.plan
+    # 0. Verifica lunghezza massima dell'input
+    max_length = plan.get("max_input_length")
+    if max_length is not None and len(payload.text) > max_length:
+        raise HTTPException(
+            status_code=413, # 413 Payload Too Large
+            detail=f"Il documento inserito ({len(payload.text)} caratteri) supera il limite di {max_length} caratteri consentito per il tuo piano. Esegui l'upgrade per analizzare documenti più lunghi."
+        )
+    interpreter_plan = plan["interpreter"]
+    if auth.tier_name == 'free':
+        model_to_use = ai_core.VALIDATOR_MODEL_NAME # Modello economico
+    else:
+        model_to_use = ai_core.INTERPRETER_MODEL_NAME # Modello potente
+    # 1. Verifica profilo consentito
+    if interpreter_plan["allowed_profiles"] != "all" and payload.profile_name not in interpreter_plan["allowed_profiles"]:
+        raise HTTPException(status_code=403, detail=f"Il profilo Interpreter '{payload.profile_name}' non è incluso nel tuo piano.")
+    estimated_tokens = _check_token_budget(auth, "interpreter", payload, model_to_use)
+    return interpreter_plan, model_to_use, estimated_tokens
+
+def _prepare_compliance_request(payload: TextInput, auth: AuthContext):
+    plan = auth.plan
+    if not plan["compliance_checkr"]["enabled"]:
+        raise HTTPException(status_code=403, detail="Il Compliance Checkr non è incluso nel tuo piano.")
+    # 0. Verifica lunghezza massima dell'input
+    max_length = plan.get("max_input_length")
+    if max_length is not None and len(payload.text) > max_length:
+        raise HTTPException(
+            status_code=413, # 413 Payload Too Large
+            detail=f"Il documento inserito ({len(payload.text)} caratteri) supera il limite di {max_length} caratteri consentito per il tuo piano. Esegui l'upgrade per analizzare documenti più lunghi."
+        )
+    return _check_token_budget(auth, "compliance", payload, ai_core.COMPLIANCE_MODEL_NAME)
+
+def _prepare_strategist_request(payload: TextInput, auth: AuthContext):
+    plan = auth.plan
     if not plan["strategist"]["enabled"]:
         raise HTTPException(status_code=403, detail="Lo Strategist non è incluso nel tuo piano. Esegui l'upgrade al piano Pro.")
-
     # Verifica lunghezza massima dell'input
     max_length = plan.get("max_input_length")
     if max_length is not None and len(payload.text) > max_length:
@@ -273,308 +900,365 @@ async def create_strategy(request: Request, payload: TextInput, authorization: s
             status_code=413,
             detail=f"Il testo inserito supera il limite di {max_length} caratteri per il tuo piano."
         )
+    return _check_token_budget(auth, "strategist", payload, ai_core.STRATEGIST_MODEL_NAME)
+
+def _ai_error(e: Exception, detail: str) -> HTTPException:
+    # Modello saturo (coda del dispatcher piena) o circuito aperto: 503 con Retry-After,
+    # così il client sa quando riprovare; qualsiasi altro errore resta un 500.
+    cause = e
+    while cause is not None and not isinstance(cause, ai_core.ModelUnavailableError):
+        cause = cause.__cause__ or cause.__context__
+    if cause is not None:
+        return HTTPException(status_code=503, detail=str(cause), headers={"Retry-After": str(cause.retry_after)})
+    return HTTPException(status_code=500, detail=f"{detail}: {str(e)}")
+
+def _build_quality_report(quality_report_data: dict) -> Optional[QualityReport]:
+    if "error" not in quality_report_data and "human_quality_score" in quality_report_data:
+        # ARROTONDA IL PUNTEGGIO ALL'INTERO PIÙ VICINO
+        score = quality_report_data.get("human_quality_score", 0)
+        quality_report_data["human_quality_score"] = round(score)
+        return QualityReport(**quality_report_data)
+    return None
+
+async def _run_validator(text: str, profile_name: str, validator_plan: dict, model_to_use: str, ctov_data: Optional[dict]):
+    # Riscrittura più eventuale quality score: in un'unica chiamata per i profili che lo
+    # prevedono (e senza CTOV), altrimenti con le due chiamate separate.
+    if validator_plan["quality_check"] and not ctov_data and ai_core.uses_fused_quality_check(profile_name):
+        fused = await ai_core.normalize_and_score(text, profile_name=profile_name, model_name=model_to_use)
+        return fused["normalized_text"], _build_quality_report(dict(fused["quality_report"]))
+
+    normalized_text = await ai_core.normalize_text(text, profile_name=profile_name, model_name=model_to_use, ctov_data=ctov_data)
+    quality_report_obj = None
+    if validator_plan["quality_check"]:
+        quality_report_data = await ai_core.score_quality(original_text=text, normalized_text=normalized_text, profile_name=profile_name, model_name=model_to_use, ctov_data=ctov_data, full_reasoning=validator_plan.get("full_quality_reasoning", False))
+        quality_report_obj = _build_quality_report(quality_report_data)
+    return normalized_text, quality_report_obj
+
+
+# ==============================================================================
+# === NUOVO ENDPOINT: STRATEGIST ===============================================
+# ==============================================================================
+@app.post("/strategist", response_model=StrategyResponse, tags=["Strategist"])
+@limiter.limit("5/minute")
+async def create_strategy(request: Request, payload: TextInput, auth: AuthContext = Depends(get_auth_context)):
+    # --- LOGICA DI GESTIONE PIANI PER STRATEGIST ---
+    estimated_tokens = _prepare_strategist_request(payload, auth)
     
-    # Verifica limite di chiamate condiviso
-    shared_limit = plan["shared_limit"]
-    current_count = profile.get('usage_count', 0)
-    if shared_limit != -1:
-        today = str(date.today())
-        if profile.get('last_used_date') != today:
-            current_count = 0
-            supabase.table('profiles').update({'last_used_date': today, 'usage_count': 0}).eq('id', user_id).execute()
-        if current_count >= shared_limit:
-            raise HTTPException(status_code=429, detail=f"Hai superato il limite giornaliero condiviso di {shared_limit} chiamate.")
+    # Prenotazione sul limite di chiamate condiviso
+    shared_limit = auth.plan["shared_limit"]
+    reservation = await reserve_usage(auth)
             
     try:
         strategy_text = await ai_core.generate_strategy(payload.text, profile_name=payload.profile_name)
     except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Errore durante la generazione della strategia: {str(e)}")
+        await reservation.release()
+        raise _ai_error(e, "Errore durante la generazione della strategia")
+    except BaseException:
+        reservation.release_in_background()
+        raise
     
-    # Aggiornamento conteggio
-    new_count = current_count + 1
-    if shared_limit != -1:
-        supabase.table('profiles').update({'usage_count': new_count}).eq('id', user_id).execute()
+    # Conferma del conteggio
+    await reservation.commit()
 
     return StrategyResponse(
             strategy_text=strategy_text.strip(),
-            usage=UsageInfo(count=new_count, limit=shared_limit)
+            usage=UsageInfo(count=reservation.count, limit=shared_limit, estimated_tokens=estimated_tokens)
         )
 
 @app.get("/health", tags=["Monitoring"])
 async def read_health():
     return {"status": "ok"}
 
+# --- ACCESSO A /metrics ---
+# Le metriche espongono lo stato interno del servizio (quote prenotate, circuit breaker,
+# code del dispatcher, cache): accesso solo agli admin oppure ai sistemi di monitoraggio
+# con il token condiviso METRICS_TOKEN nell'header X-Metrics-Token.
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+
+async def require_metrics_access(authorization: str = Header(None), x_metrics_token: str = Header(None)):
+    if METRICS_TOKEN and x_metrics_token and hmac.compare_digest(x_metrics_token, METRICS_TOKEN):
+        return
+    auth = await get_auth_context(authorization)
+    if auth.role != 'admin':
+        raise HTTPException(status_code=403, detail="Accesso alle metriche riservato agli amministratori.")
+
+@app.get("/metrics", tags=["Monitoring"], dependencies=[Depends(require_metrics_access)])
+async def read_metrics():
+    return {
+        "verified_token_cache": verified_token_cache.stats(),
+        "profile_cache": {**profile_cache_stats, "enabled": redis_client is not None},
+        "ctov_cache": {**ctov_cache_stats, "local_size": len(_ctov_local_cache), "redis_enabled": redis_client is not None},
+        "usage_reservations": usage_reservation_stats,
+        "response_cache": ai_core.response_cache.snapshot(),
+        "hedging": ai_core.hedging_policy.snapshot(),
+        "generation_retries": ai_core.retry_stats,
+        "circuit_breakers": ai_core.circuit_breakers.snapshot(),
+        "dispatcher": ai_core.dispatcher.snapshot(),
+        "quality_report_parsing": ai_core.quality_parse_snapshot(),
+        "quality_prescoring": ai_core.quality_prescore_stats,
+        "ctov_banned_terms": ai_core.banned_term_snapshot()
+    }
+
 
 @app.post("/validate", response_model=ValidationResponse, tags=["Validator"])
 @limiter.limit("5/minute")
-async def validate_text(request: Request, payload: TextInput, authorization: str = Header(None)):
-    user_id, profile = await get_user_profile_from_token(authorization)
-    if not authorization or not authorization.startswith("Bearer "):
-        raise HTTPException(status_code=401, detail="Token di autenticazione mancante.")
-
-    # ... la logica di validazione del token e recupero profilo rimane IDENTICA ...
-    # ... fino a dopo il recupero del 'profile' ...
-    
-    clerk_jwt_token_string = authorization.split(" ")[1]
-    user_id = None
-    try:
-        # Logica di validazione token...
-        jwks_response = requests.get(CLERK_JWKS_URL)
-        jwks_response.raise_for_status()
-        jwks_data = jwks_response.json()
-        header = jwt.get_unverified_header(clerk_jwt_token_string)
-        public_key = None
-        for key_data in jwks_data["keys"]:
-            if key_data["kid"] == header["kid"]:
-                public_key = jwk.construct(key_data)
-                break
-        if not public_key: raise Exception("Chiave pubblica non trovata.")
-        options = {
-            "verify_signature": True, 
-            "verify_aud": False, 
-            "verify_iss": False,
-            "leeway": 5
-        }
-        decoded_token = jwt.decode(clerk_jwt_token_string, public_key, algorithms=["RS256"], options=options)
-        user_id = decoded_token.get("sub")
-        if not user_id: raise Exception("ID utente non trovato.")
-    except Exception as e:
-        raise HTTPException(status_code=401, detail=f"Validazione token fallita: {str(e)}")
-
-    profile_res = supabase.table('profiles').select('*').eq('id', user_id).execute()
-    if not profile_res.data:
-        raise HTTPException(status_code=500, detail="Profilo utente non trovato.")
-    profile = profile_res.data[0]
-    
+async def validate_text(request: Request, payload: TextInput, auth: AuthContext = Depends(get_auth_context)):
     # --- NUOVA LOGICA DI GESTIONE PIANI PER VALIDATOR ---
-    user_tier_name = profile.get('subscription_tier', 'free')
-    user_role = profile.get('role', 'user')
-    plan = PLANS.get("admin") if user_role == 'admin' else PLANS.get(user_tier_name, PLANS["free"])
-    # === INIZIO BLOCCO DA AGGIUNGERE ===
-    # 0. Verifica lunghezza massima dell'input
-    max_length = plan.get("max_input_length")
-    if max_length is not None and len(payload.text) > max_length:
-        raise HTTPException(
-            status_code=413, # 413 Payload Too Large
-            detail=f"Il testo inserito ({len(payload.text)} caratteri) supera il limite di {max_length} caratteri consentito per il tuo piano. Esegui l'upgrade per analizzare documenti più lunghi."
-        )
-    # === FINE BLOCCO DA AGGIUNGERE ===
-    validator_plan = plan["validator"]
-    model_to_use = ai_core.VALIDATOR_MODEL_NAME
-    # 1. Verifica profilo consentito
-    if validator_plan["allowed_profiles"] != "all" and payload.profile_name not in validator_plan["allowed_profiles"]:
-        raise HTTPException(status_code=403, detail=f"Il profilo Validator '{payload.profile_name}' non è incluso nel tuo piano.")
+    validator_plan, model_to_use, ctov_data, estimated_tokens = await _prepare_validator_request(payload, auth)
 
-    # 2. Verifica limite di chiamate condiviso
-    shared_limit = plan["shared_limit"]
-    current_count = profile.get('usage_count', 0)
-    if shared_limit != -1:
-        today = str(date.today())
-        if profile.get('last_used_date') != today:
-            current_count = 0
-            supabase.table('profiles').update({'last_used_date': today, 'usage_count': 0}).eq('id', user_id).execute()
-        if current_count >= shared_limit:
-            raise HTTPException(status_code=429, detail=f"Hai superato il limite giornaliero condiviso di {shared_limit} chiamate.")
-    
-    ctov_data = None
-    if payload.ctov_profile_id:
-        # Se viene richiesto un profilo CTOV, recuperalo
-        ctov_res = supabase.table('ctov_profiles').select('*').eq('id', payload.ctov_profile_id).eq('user_id', user_id).single().execute()
-        if not ctov_res.data:
-            raise HTTPException(status_code=404, detail="Profilo Custom Tone of Voice non trovato o non autorizzato.")
-        ctov_data = ctov_res.data
+    # 2. Prenotazione sul limite di chiamate condiviso
+    shared_limit = auth.plan["shared_limit"]
+    reservation = await reserve_usage(auth)
         
     # --- ELABORAZIONE AI ---
     try:
-        normalized_text = await ai_core.normalize_text(payload.text, profile_name=payload.profile_name, model_name=model_to_use, ctov_data=ctov_data)
-        
-        quality_report_obj = None
-        if validator_plan["quality_check"]:
-            quality_report_data = await ai_core.get_quality_score(original_text=payload.text, normalized_text=normalized_text, profile_name=payload.profile_name, model_name=model_to_use)
-            if "error" not in quality_report_data and "human_quality_score" in quality_report_data:
-                score = quality_report_data.get("human_quality_score", 0)
-                quality_report_data["human_quality_score"] = round(score)
-                quality_report_obj = QualityReport(**quality_report_data)
+        normalized_text, quality_report_obj = await _run_validator(payload.text, payload.profile_name, validator_plan, model_to_use, ctov_data)
 
     except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Errore durante l'elaborazione AI: {str(e)}")
+        await reservation.release()
+        raise _ai_error(e, "Errore durante l'elaborazione AI")
+    except BaseException:
+        reservation.release_in_background()
+        raise
 
-    # --- AGGIORNAMENTO CONTEGGIO ---
-    new_count = current_count + 1
-    if shared_limit != -1:
-        supabase.table('profiles').update({'usage_count': new_count}).eq('id', user_id).execute()
+    # --- CONFERMA CONTEGGIO ---
+    await reservation.commit()
 
     return ValidationResponse(
         normalized_text=normalized_text.strip(),
         quality_report=quality_report_obj,
-        usage=UsageInfo(count=new_count, limit=shared_limit)
+        usage=UsageInfo(count=reservation.count, limit=shared_limit, estimated_tokens=estimated_tokens)
     )
 
 @app.post("/interpret", response_model=InterpretationResponse, tags=["Interpreter"])
 @limiter.limit("5/minute")
-async def interpret_document(request: Request, payload: TextInput, authorization: str = Header(None)):
-    if not authorization or not authorization.startswith("Bearer "):
-        raise HTTPException(status_code=401, detail="Token di autenticazione mancante.")
-
-    # ... la logica di validazione del token e recupero profilo è IDENTICA a /validate ...
-    clerk_jwt_token_string = authorization.split(" ")[1]
-    user_id = None
-    try:
-        # Logica di validazione token...
-        jwks_response = requests.get(CLERK_JWKS_URL)
-        jwks_response.raise_for_status()
-        jwks_data = jwks_response.json()
-        header = jwt.get_unverified_header(clerk_jwt_token_string)
-        public_key = None
-        for key_data in jwks_data["keys"]:
-            if key_data["kid"] == header["kid"]:
-                public_key = jwk.construct(key_data)
-                break
-        if not public_key: raise Exception("Chiave pubblica non trovata.")
-        decoded_token = jwt.decode(clerk_jwt_token_string, public_key, algorithms=["RS256"], options={"verify_signature": True, "verify_aud": False, "verify_iss": False})
-        user_id = decoded_token.get("sub")
-        if not user_id: raise Exception("ID utente non trovato.")
-    except Exception as e:
-        raise HTTPException(status_code=401, detail=f"Validazione token fallita: {str(e)}")
-
-    profile_res = supabase.table('profiles').select('*').eq('id', user_id).execute()
-    if not profile_res.data:
-        raise HTTPException(status_code=500, detail="Profilo utente non trovato.")
-    profile = profile_res.data[0]
-
+async def interpret_document(request: Request, payload: TextInput, auth: AuthContext = Depends(get_auth_context)):
     # --- NUOVA LOGICA DI GESTIONE PIANI PER INTERPRETER ---
-    user_tier_name = profile.get('subscription_tier', 'free')
-    user_role = profile.get('role', 'user')
-    plan = PLANS.get("admin") if user_role == 'admin' else PLANS.get(user_tier_name, PLANS["free"])
-    # === INIZIO BLOCCO DA AGGIUNGERE ===
-    # 0. Verifica lunghezza massima dell'input
-    max_length = plan.get("max_input_length")
-    if max_length is not None and len(payload.text) > max_length:
-        raise HTTPException(
-            status_code=413, # 413 Payload Too Large
-            detail=f"Il documento inserito ({len(payload.text)} caratteri) supera il limite di {max_length} caratteri consentito per il tuo piano. Esegui l'upgrade per analizzare documenti più lunghi."
-        )
-    # === FINE BLOCCO DA AGGIUNGERE ===
-    interpreter_plan = plan["interpreter"]
-    if user_tier_name == 'free':
-        model_to_use = ai_core.VALIDATOR_MODEL_NAME # Modello economico
-    else:
-        model_to_use = ai_core.INTERPRETER_MODEL_NAME # Modello potente
-    # 1. Verifica profilo consentito
-    if interpreter_plan["allowed_profiles"] != "all" and payload.profile_name not in interpreter_plan["allowed_profiles"]:
-        raise HTTPException(status_code=403, detail=f"Il profilo Interpreter '{payload.profile_name}' non è incluso nel tuo piano.")
+    interpreter_plan, model_to_use, estimated_tokens = _prepare_interpreter_request(payload, auth)
 
-    # 2. Verifica limite di chiamate condiviso (identica a /validate)
-    shared_limit = plan["shared_limit"]
-    current_count = profile.get('usage_count', 0)
-    if shared_limit != -1:
-        today = str(date.today())
-        if profile.get('last_used_date') != today:
-            current_count = 0
-            supabase.table('profiles').update({'last_used_date': today, 'usage_count': 0}).eq('id', user_id).execute()
-        if current_count >= shared_limit:
-            raise HTTPException(status_code=429, detail=f"Hai superato il limite giornaliero condiviso di {shared_limit} chiamate.")
+    # 2. Prenotazione sul limite di chiamate condiviso (identica a /validate)
+    shared_limit = auth.plan["shared_limit"]
+    reservation = await reserve_usage(auth)
 
     # --- ELABORAZIONE AI con le nuove funzioni di ai_core ---
     try:
         interpreted_text = await ai_core.interpret_text(payload.text, profile_name=payload.profile_name, model_name=model_to_use)
         
         quality_report_obj = None
-        if interpreter_plan["quality_check"]:
+        if interpreter_plan["quality_check"] and ai_core.interpreter_quality_check_applies(payload.text):
             quality_report_data = await ai_core.get_interpreter_quality_score(original_text=payload.text, interpreted_text=interpreted_text, profile_name=payload.profile_name, model_name=model_to_use)
-            if "error" not in quality_report_data and "human_quality_score" in quality_report_data:
-                # ARROTONDA IL PUNTEGGIO ALL'INTERO PIÙ VICINO
-                score = quality_report_data.get("human_quality_score", 0)
-                quality_report_data["human_quality_score"] = round(score)
-                quality_report_obj = QualityReport(**quality_report_data)
+            quality_report_obj = _build_quality_report(quality_report_data)
     
     except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Errore durante l'elaborazione AI: {str(e)}")
+        await reservation.release()
+        raise _ai_error(e, "Errore durante l'elaborazione AI")
+    except BaseException:
+        reservation.release_in_background()
+        raise
 
-    # --- AGGIORNAMENTO CONTEGGIO ---
-    new_count = current_count + 1
-    if shared_limit != -1:
-        supabase.table('profiles').update({'usage_count': new_count}).eq('id', user_id).execute()
+    # --- CONFERMA CONTEGGIO ---
+    await reservation.commit()
 
     return InterpretationResponse(
         interpreted_text=interpreted_text.strip(),
         quality_report=quality_report_obj,
-        usage=UsageInfo(count=new_count, limit=shared_limit)
+        usage=UsageInfo(count=reservation.count, limit=shared_limit, estimated_tokens=estimated_tokens)
     )
 
 
 @app.post("/compliance-check", response_model=ComplianceResponse, tags=["Compliance Checkr"])
 @limiter.limit("5/minute")
-async def compliance_check(request: Request, payload: TextInput, authorization: str = Header(None)):
-    if not authorization or not authorization.startswith("Bearer "):
-        raise HTTPException(status_code=401, detail="Token di autenticazione mancante.")
-
-    # ... la logica di validazione del token e recupero profilo è IDENTICA a /validate ...
-    clerk_jwt_token_string = authorization.split(" ")[1]
-    user_id = None
-    try:
-        # Logica di validazione token...
-        jwks_response = requests.get(CLERK_JWKS_URL)
-        jwks_response.raise_for_status()
-        jwks_data = jwks_response.json()
-        header = jwt.get_unverified_header(clerk_jwt_token_string)
-        public_key = None
-        for key_data in jwks_data["keys"]:
-            if key_data["kid"] == header["kid"]:
-                public_key = jwk.construct(key_data)
-                break
-        if not public_key: raise Exception("Chiave pubblica non trovata.")
-        decoded_token = jwt.decode(clerk_jwt_token_string, public_key, algorithms=["RS256"], options={"verify_signature": True, "verify_aud": False, "verify_iss": False})
-        user_id = decoded_token.get("sub")
-        if not user_id: raise Exception("ID utente non trovato.")
-    except Exception as e:
-        raise HTTPException(status_code=401, detail=f"Validazione token fallita: {str(e)}")
-
-    profile_res = supabase.table('profiles').select('*').eq('id', user_id).execute()
-    if not profile_res.data:
-        raise HTTPException(status_code=500, detail="Profilo utente non trovato.")
-    profile = profile_res.data[0]
-    
+async def compliance_check(request: Request, payload: TextInput, auth: AuthContext = Depends(get_auth_context)):
     # --- LOGICA DI GESTIONE PIANI PER COMPLIANCE CHECKR ---
-    user_tier_name = profile.get('subscription_tier', 'free')
-    user_role = profile.get('role', 'user')
-    plan = PLANS.get("admin") if user_role == 'admin' else PLANS.get(user_tier_name, PLANS["free"])
-    
-    if not plan["compliance_checkr"]["enabled"]:
-        raise HTTPException(status_code=403, detail="Il Compliance Checkr non è incluso nel tuo piano.")
-    # 0. Verifica lunghezza massima dell'input
-    max_length = plan.get("max_input_length")
-    if max_length is not None and len(payload.text) > max_length:
-        raise HTTPException(
-            status_code=413, # 413 Payload Too Large
-            detail=f"Il documento inserito ({len(payload.text)} caratteri) supera il limite di {max_length} caratteri consentito per il tuo piano. Esegui l'upgrade per analizzare documenti più lunghi."
-        )
-    # === FINE BLOCCO DA AGGIUNGERE ===
-    # 2. Verifica limite di chiamate condiviso (identica a /validate)
-    shared_limit = plan["shared_limit"]
-    current_count = profile.get('usage_count', 0)
-    if shared_limit != -1:
-        today = str(date.today())
-        if profile.get('last_used_date') != today:
-            current_count = 0
-            supabase.table('profiles').update({'last_used_date': today, 'usage_count': 0}).eq('id', user_id).execute()
-        if current_count >= shared_limit:
-            raise HTTPException(status_code=429, detail=f"Hai superato il limite giornaliero condiviso di {shared_limit} chiamate.")
+    estimated_tokens = _prepare_compliance_request(payload, auth)
+
+    # 2. Prenotazione sul limite di chiamate condiviso (identica a /validate)
+    shared_limit = auth.plan["shared_limit"]
+    reservation = await reserve_usage(auth)
     try:
         compliance_report_text = await ai_core.check_compliance(payload.text, profile_name=payload.profile_name)
     except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Errore durante l'analisi di conformità: {str(e)}")
+        await reservation.release()
+        raise _ai_error(e, "Errore durante l'analisi di conformità")
+    except BaseException:
+        reservation.release_in_background()
+        raise
     
-    # --- AGGIORNAMENTO CONTEGGIO ---
-    new_count = current_count + 1
-    if shared_limit != -1:
-        supabase.table('profiles').update({'usage_count': new_count}).eq('id', user_id).execute()
+    # --- CONFERMA CONTEGGIO ---
+    await reservation.commit()
 
     return ComplianceResponse(
             compliance_report=compliance_report_text.strip(),
-            usage=UsageInfo(count=new_count, limit=shared_limit)
+            usage=UsageInfo(count=reservation.count, limit=shared_limit, estimated_tokens=estimated_tokens)
         )
-    
+
+
+# ==============================================================================
+# === STREAMING (SERVER-SENT EVENTS) ===========================================
+# ==============================================================================
+# Varianti opt-in degli endpoint AI: i token vengono inoltrati man mano che il modello
+# li genera (evento `chunk`), seguiti da `quality_report` (se previsto dal piano),
+# `usage` e `done`. Gli errori durante la generazione arrivano come evento `error`
+# e la quota prenotata viene restituita, anche se il client si disconnette.
+
+def _sse_event(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+def _sse_response(reservation: UsageReservation, shared_limit: int, estimated_tokens: int, chunks, quality_scorer=None) -> StreamingResponse:
+    async def event_stream():
+        completed = False
+        try:
+            parts = []
+            async for chunk in chunks:
+                parts.append(chunk)
+                yield _sse_event("chunk", {"text": chunk})
+            if quality_scorer is not None:
+                quality_report_obj = _build_quality_report(await quality_scorer("".join(parts)))
+                yield _sse_event("quality_report", quality_report_obj.model_dump() if quality_report_obj else None)
+            completed = True
+            await reservation.commit()
+            yield _sse_event("usage", UsageInfo(count=reservation.count, limit=shared_limit, estimated_tokens=estimated_tokens).model_dump())
+            yield _sse_event("done", {})
+        except Exception as e:
+            yield _sse_event("error", {"detail": f"Errore durante l'elaborazione AI: {str(e)}"})
+        finally:
+            if not completed:
+                reservation.release_in_background()
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@app.post("/validate/stream", tags=["Validator"])
+@limiter.limit("5/minute")
+async def validate_text_stream(request: Request, payload: TextInput, auth: AuthContext = Depends(get_auth_context)):
+    validator_plan, model_to_use, ctov_data, estimated_tokens = await _prepare_validator_request(payload, auth)
+    reservation = await reserve_usage(auth)
+
+    quality_scorer = None
+    if validator_plan["quality_check"]:
+        async def quality_scorer(normalized_text: str):
+            return await ai_core.score_quality(original_text=payload.text, normalized_text=normalized_text, profile_name=payload.profile_name, model_name=model_to_use, ctov_data=ctov_data, full_reasoning=validator_plan.get("full_quality_reasoning", False))
+
+    chunks = ai_core.stream_normalize_text(payload.text, profile_name=payload.profile_name, model_name=model_to_use, ctov_data=ctov_data)
+    return _sse_response(reservation, auth.plan["shared_limit"], estimated_tokens, chunks, quality_scorer)
+
+@app.post("/interpret/stream", tags=["Interpreter"])
+@limiter.limit("5/minute")
+async def interpret_document_stream(request: Request, payload: TextInput, auth: AuthContext = Depends(get_auth_context)):
+    interpreter_plan, model_to_use, estimated_tokens = _prepare_interpreter_request(payload, auth)
+    reservation = await reserve_usage(auth)
+
+    quality_scorer = None
+    if interpreter_plan["quality_check"] and ai_core.interpreter_quality_check_applies(payload.text):
+        async def quality_scorer(interpreted_text: str):
+            return await ai_core.get_interpreter_quality_score(original_text=payload.text, interpreted_text=interpreted_text, profile_name=payload.profile_name, model_name=model_to_use)
+
+    chunks = ai_core.stream_interpret_text(payload.text, profile_name=payload.profile_name, model_name=model_to_use)
+    return _sse_response(reservation, auth.plan["shared_limit"], estimated_tokens, chunks, quality_scorer)
+
+@app.post("/compliance-check/stream", tags=["Compliance Checkr"])
+@limiter.limit("5/minute")
+async def compliance_check_stream(request: Request, payload: TextInput, auth: AuthContext = Depends(get_auth_context)):
+    estimated_tokens = _prepare_compliance_request(payload, auth)
+    reservation = await reserve_usage(auth)
+    chunks = ai_core.stream_check_compliance(payload.text, profile_name=payload.profile_name)
+    return _sse_response(reservation, auth.plan["shared_limit"], estimated_tokens, chunks)
+
+@app.post("/strategist/stream", tags=["Strategist"])
+@limiter.limit("5/minute")
+async def create_strategy_stream(request: Request, payload: TextInput, auth: AuthContext = Depends(get_auth_context)):
+    estimated_tokens = _prepare_strategist_request(payload, auth)
+    reservation = await reserve_usage(auth)
+    chunks = ai_core.stream_generate_strategy(payload.text, profile_name=payload.profile_name)
+    return _sse_response(reservation, auth.plan["shared_limit"], estimated_tokens, chunks)
+
+
+# ==============================================================================
+# === BATCH ====================================================================
+# ==============================================================================
+# N testi con un unico profilo: autenticazione e controlli di piano una sola volta,
+# quota prenotata per tutto il batch in un solo passaggio, chiamate ad ai_core in
+# parallelo (massimo BATCH_CONCURRENCY alla volta) ed esito riportato per ogni testo.
+# Le unità dei testi falliti vengono restituite alla quota.
+
+def _batch_as_text_input(payload: BatchTextInput) -> TextInput:
+    # I controlli di piano sul testo più lungo valgono per tutto il batch.
+    return TextInput(text=max(payload.texts, key=len), profile_name=payload.profile_name, ctov_profile_id=payload.ctov_profile_id)
+
+async def _run_batch(texts: List[str], worker, reservation: UsageReservation) -> List[BatchItemResult]:
+    semaphore = asyncio.Semaphore(BATCH_CONCURRENCY)
+
+    async def run_item(index: int, text: str) -> BatchItemResult:
+        async with semaphore:
+            try:
+                result_text, quality_report_obj = await worker(text)
+                return BatchItemResult(index=index, status="ok", result=result_text.strip(), quality_report=quality_report_obj)
+            except Exception as e:
+                return BatchItemResult(index=index, status="error", error=str(e))
+
+    try:
+        return await asyncio.gather(*(run_item(index, text) for index, text in enumerate(texts)))
+    except BaseException:
+        # Batch interrotto (client disconnesso, shutdown): nessun esito da confermare.
+        reservation.release_in_background()
+        raise
+
+def _batch_estimated_tokens(payload: BatchTextInput, module: str, model_name: str, ctov_data: Optional[dict] = None) -> int:
+    return sum(ai_core.estimate_prompt_tokens(module, payload.profile_name, model_name, text, ctov_data) for text in payload.texts)
+
+async def _batch_response(reservation: UsageReservation, shared_limit: int, estimated_tokens: int, results: List[BatchItemResult]) -> BatchResponse:
+    succeeded = sum(1 for item in results if item.status == "ok")
+    await reservation.settle(succeeded)
+    return BatchResponse(
+        results=results,
+        succeeded=succeeded,
+        failed=len(results) - succeeded,
+        usage=UsageInfo(count=reservation.count, limit=shared_limit, estimated_tokens=estimated_tokens)
+    )
+
+@app.post("/validate/batch", response_model=BatchResponse, tags=["Validator"])
+@limiter.limit("5/minute")
+async def validate_batch(request: Request, payload: BatchTextInput, auth: AuthContext = Depends(get_auth_context)):
+    validator_plan, model_to_use, ctov_data, _ = await _prepare_validator_request(_batch_as_text_input(payload), auth)
+    estimated_tokens = _batch_estimated_tokens(payload, "validator", model_to_use, ctov_data)
+    reservation = await reserve_usage(auth, units=len(payload.texts))
+
+    async def worker(text: str):
+        return await _run_validator(text, payload.profile_name, validator_plan, model_to_use, ctov_data)
+
+    results = await _run_batch(payload.texts, worker, reservation)
+    return await _batch_response(reservation, auth.plan["shared_limit"], estimated_tokens, results)
+
+@app.post("/interpret/batch", response_model=BatchResponse, tags=["Interpreter"])
+@limiter.limit("5/minute")
+async def interpret_batch(request: Request, payload: BatchTextInput, auth: AuthContext = Depends(get_auth_context)):
+    interpreter_plan, model_to_use, _ = _prepare_interpreter_request(_batch_as_text_input(payload), auth)
+    estimated_tokens = _batch_estimated_tokens(payload, "interpreter", model_to_use)
+    reservation = await reserve_usage(auth, units=len(payload.texts))
+
+    async def worker(text: str):
+        interpreted_text = await ai_core.interpret_text(text, profile_name=payload.profile_name, model_name=model_to_use)
+        quality_report_obj = None
+        if interpreter_plan["quality_check"] and ai_core.interpreter_quality_check_applies(text):
+            quality_report_data = await ai_core.get_interpreter_quality_score(original_text=text, interpreted_text=interpreted_text, profile_name=payload.profile_name, model_name=model_to_use)
+            quality_report_obj = _build_quality_report(quality_report_data)
+        return interpreted_text, quality_report_obj
+
+    results = await _run_batch(payload.texts, worker, reservation)
+    return await _batch_response(reservation, auth.plan["shared_limit"], estimated_tokens, results)
+
+@app.post("/compliance-check/batch", response_model=BatchResponse, tags=["Compliance Checkr"])
+@limiter.limit("5/minute")
+async def compliance_check_batch(request: Request, payload: BatchTextInput, auth: AuthContext = Depends(get_auth_context)):
+    _prepare_compliance_request(_batch_as_text_input(payload), auth)
+    estimated_tokens = _batch_estimated_tokens(payload, "compliance", ai_core.COMPLIANCE_MODEL_NAME)
+    reservation = await reserve_usage(auth, units=len(payload.texts))
+
+    async def worker(text: str):
+        return await ai_core.check_compliance(text, profile_name=payload.profile_name), None
+
+    results = await _run_batch(payload.texts, worker, reservation)
+    return await _batch_response(reservation, auth.plan["shared_limit"], estimated_tokens, results)
+
 
 @app.post("/webhooks/new-user", include_in_schema=False) # Nascosto dalla documentazione pubblica
 async def handle_new_user_webhook(request: Request, payload: dict, x_webhook_secret: str = Header(None)):
@@ -610,14 +1294,15 @@ async def handle_new_user_webhook(request: Request, payload: dict, x_webhook_sec
     print(f"Webhook ricevuto: Tentativo di creazione profilo per utente {user_id}...")
     try:
         # Usiamo il client Supabase (con service_key) per creare il profilo
-        insert_res = supabase.table('profiles').insert({
+        insert_res = await run_query(supabase.table('profiles').insert({
             'id': user_id,
             'email': user_email 
-        }).execute()
+        }))
         
         # Controllo di sicurezza: verifichiamo che l'inserimento sia andato a buon fine
         if not insert_res.data:
              raise Exception(f"L'inserimento del profilo per {user_id} non ha restituito dati.")
+        await cache_profile(insert_res.data[0])
 
     except Exception as e:
         print(f"!!! ERRORE WEBHOOK: Impossibile creare il profilo per {user_id}. Errore: {str(e)}")
@@ -680,10 +1365,11 @@ async def clerk_webhook_handler(request: Request, response: Response):
             "usage_count": 0,
             "role": "user"
         }
-            insert_res = supabase.table('profiles').insert(data_to_insert).execute()
+            insert_res = await run_query(supabase.table('profiles').insert(data_to_insert))
             
             if not insert_res.data:
                 raise Exception(f"L'inserimento del profilo per {user_id} non ha restituito dati.")
+            await cache_profile(insert_res.data[0])
 
             logging.info(f"Profilo creato con successo per l'utente {user_id} via webhook.")
             return {"message": f"User {user_id} provisioned successfully."}
@@ -699,7 +1385,8 @@ async def clerk_webhook_handler(request: Request, response: Response):
             # Logica per eliminare o anonimizzare i dati in public.profiles.
             # Esempio: supabase.table('profiles').delete().eq('id', user_id).execute()
             # O aggiornare: supabase.table('profiles').update({'email': null, 'usage_count': 0}).eq('id', user_id).execute()
-            delete_res = supabase.table('profiles').delete().eq('id', user_id).execute()
+            delete_res = await run_query(supabase.table('profiles').delete().eq('id', user_id))
+            await invalidate_profile(user_id)
             if not delete_res.data:
                 logging.warning(f"Nessun profilo trovato o eliminato per l'utente {user_id} (potrebbe essere già stato cancellato).")
             logging.info(f"Profilo eliminato/anonimizzato per user {user_id}.")
@@ -713,12 +1400,9 @@ async def clerk_webhook_handler(request: Request, response: Response):
         return {"message": f"Event type {event_type} acknowledged, no action taken."}
 
 @app.post("/ctov-profiles", response_model=CTOVProfileResponse, tags=["Custom Tone of Voice"])
-async def create_ctov_profile(payload: CTOVProfileCreate, authorization: str = Header(None)):
-    # 1. Autenticazione e recupero profilo/piano (codice standard)
-    user_id, profile = await get_user_profile_from_token(authorization)
-    user_tier_name = profile.get('subscription_tier', 'free')
-    user_role = profile.get('role', 'user')
-    plan = PLANS.get("admin") if user_role == 'admin' else PLANS.get(user_tier_name, PLANS["free"])
+async def create_ctov_profile(payload: CTOVProfileCreate, auth: AuthContext = Depends(get_auth_context)):
+    # 1. Autenticazione e recupero profilo/piano (risolti dalla dipendenza)
+    user_id, plan = auth.user_id, auth.plan
 
     # 2. Verifica se la funzionalità è abilitata per il piano
     ctov_plan = plan["ctov"]
@@ -728,7 +1412,7 @@ async def create_ctov_profile(payload: CTOVProfileCreate, authorization: str = H
     # 3. Verifica il limite massimo di profili
     max_profiles = ctov_plan["max_profiles"]
     if max_profiles != -1:
-        count_res = supabase.table('ctov_profiles').select('id', count='exact').eq('user_id', user_id).execute()
+        count_res = await run_query(supabase.table('ctov_profiles').select('id', count='exact').eq('user_id', user_id))
         if count_res.count is not None and count_res.count >= max_profiles:
             raise HTTPException(status_code=403, detail=f"Hai raggiunto il limite di {max_profiles} Voci Personalizzate per il tuo piano.")
 
@@ -736,55 +1420,57 @@ async def create_ctov_profile(payload: CTOVProfileCreate, authorization: str = H
     try:
         insert_data = payload.dict()
         insert_data['user_id'] = user_id
-        res = supabase.table('ctov_profiles').insert(insert_data).execute()
+        res = await run_query(supabase.table('ctov_profiles').insert(insert_data))
         if not res.data:
             raise Exception("Creazione profilo CTOV fallita")
         # Converte l'UUID in stringa per la risposta
         created_profile = res.data[0]
         created_profile['id'] = str(created_profile['id'])
+        await invalidate_ctov_profiles(user_id)
         return CTOVProfileResponse(**created_profile)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Errore interno durante la creazione del profilo: {str(e)}")
 
 
 @app.get("/ctov-profiles", response_model=List[CTOVProfileResponse], tags=["Custom Tone of Voice"])
-async def get_ctov_profiles(authorization: str = Header(None)):
-    user_id, _ = await get_user_profile_from_token(authorization)
-    res = supabase.table('ctov_profiles').select('*').eq('user_id', user_id).order('created_at').execute()
-    return [CTOVProfileResponse(id=str(p['id']), **p) for p in res.data]
+async def get_ctov_profiles(auth: AuthContext = Depends(get_auth_context)):
+    user_id = auth.user_id
+    return [CTOVProfileResponse(**p) for p in await load_ctov_profiles(user_id)]
 
 @app.put("/ctov-profiles/{profile_id}", response_model=CTOVProfileResponse, tags=["Custom Tone of Voice"])
-async def update_ctov_profile(profile_id: str, payload: CTOVProfileCreate, authorization: str = Header(None)):
-    user_id, _ = await get_user_profile_from_token(authorization)
+async def update_ctov_profile(profile_id: str, payload: CTOVProfileCreate, auth: AuthContext = Depends(get_auth_context)):
+    user_id = auth.user_id
     
     try:
         # L'update su Supabase include un .eq('user_id', user_id) per sicurezza:
         # l'utente può modificare solo un profilo che gli appartiene.
         update_data = payload.dict(exclude_unset=True)
-        res = supabase.table('ctov_profiles').update(update_data).eq('id', profile_id).eq('user_id', user_id).execute()
+        res = await run_query(supabase.table('ctov_profiles').update(update_data).eq('id', profile_id).eq('user_id', user_id))
         
         if not res.data:
             raise HTTPException(status_code=404, detail="Profilo non trovato o non autorizzato.")
             
         updated_profile = res.data[0]
         updated_profile['id'] = str(updated_profile['id'])
+        await invalidate_ctov_profiles(user_id)
         return CTOVProfileResponse(**updated_profile)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Errore interno durante l'aggiornamento: {str(e)}")
 
 
 @app.delete("/ctov-profiles/{profile_id}", status_code=204, tags=["Custom Tone of Voice"])
-async def delete_ctov_profile(profile_id: str, authorization: str = Header(None)):
-    user_id, _ = await get_user_profile_from_token(authorization)
+async def delete_ctov_profile(profile_id: str, auth: AuthContext = Depends(get_auth_context)):
+    user_id = auth.user_id
     
     try:
         # Anche il delete include il controllo su user_id.
-        res = supabase.table('ctov_profiles').delete().eq('id', profile_id).eq('user_id', user_id).execute()
+        res = await run_query(supabase.table('ctov_profiles').delete().eq('id', profile_id).eq('user_id', user_id))
         
         if not res.data:
             # Se nessun dato viene restituito, significa che il record non esisteva o l'utente non aveva i permessi.
             raise HTTPException(status_code=404, detail="Profilo non trovato o non autorizzato.")
         
+        await invalidate_ctov_profiles(user_id)
         return None # Ritorna una risposta 204 No Content in caso di successo
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Errore interno durante l'eliminazione: {str(e)}")
@@ -792,86 +1478,17 @@ async def delete_ctov_profile(profile_id: str, authorization: str = Header(None)
 # === FINE BLOCCO ENDPOINT CTOV ===
 
 
-# Funzione helper da aggiungere per non ripetere il codice di autenticazione
-async def get_user_profile_from_token(authorization: str):
-    if not authorization or not authorization.startswith("Bearer "):
-        raise HTTPException(status_code=401, detail="Token di autenticazione mancante.")
-    
-    clerk_jwt_token_string = authorization.split(" ")[1]
-    user_id = None
-    try:
-        # Logica di validazione token...
-        jwks_response = requests.get(CLERK_JWKS_URL)
-        jwks_response.raise_for_status()
-        jwks_data = jwks_response.json()
-        header = jwt.get_unverified_header(clerk_jwt_token_string)
-        public_key = None
-        for key_data in jwks_data["keys"]:
-            if key_data["kid"] == header["kid"]:
-                public_key = jwk.construct(key_data)
-                break
-        if not public_key: raise Exception("Chiave pubblica non trovata.")
-        decoded_token = jwt.decode(clerk_jwt_token_string, public_key, algorithms=["RS256"], options={"verify_signature": True, "verify_aud": False, "verify_iss": False})
-        user_id = decoded_token.get("sub")
-        if not user_id: raise Exception("ID utente non trovato.")
-    except Exception as e:
-        raise HTTPException(status_code=401, detail=f"Validazione token fallita: {str(e)}")
-
-    profile_res = supabase.table('profiles').select('*').eq('id', user_id).execute()
-    if not profile_res.data:
-        raise HTTPException(status_code=500, detail="Profilo utente non trovato.")
-    profile = profile_res.data[0]
-    
-    return user_id, profile
-
 @app.get("/user-status", response_model=UserStatusResponse, tags=["User Management"])
 @limiter.limit("50/minute")
-async def get_user_status(request: Request, authorization: str = Header(None)):
-    # ... la logica di validazione del token e recupero profilo rimane IDENTICA ...
-    if not authorization or not authorization.startswith("Bearer "):
-        raise HTTPException(status_code=401, detail="Token di autenticazione mancante.")
-    
-    clerk_jwt_token_string = authorization.split(" ")[1]
-    user_id = None
-    try:
-        # Logica di validazione token...
-        jwks_response = requests.get(CLERK_JWKS_URL)
-        jwks_response.raise_for_status()
-        jwks_data = jwks_response.json()
-        header = jwt.get_unverified_header(clerk_jwt_token_string)
-        public_key = None
-        for key_data in jwks_data["keys"]:
-            if key_data["kid"] == header["kid"]:
-                public_key = jwk.construct(key_data)
-                break
-        if not public_key: raise Exception("Chiave pubblica non trovata.")
-        decoded_token = jwt.decode(clerk_jwt_token_string, public_key, algorithms=["RS256"], options={"verify_signature": True, "verify_aud": False, "verify_iss": False})
-        user_id = decoded_token.get("sub")
-        if not user_id: raise Exception("ID utente non trovato.")
-    except Exception as e:
-        raise HTTPException(status_code=401, detail=f"Validazione token fallita: {str(e)}")
-
-    profile_res = supabase.table('profiles').select('*').eq('id', user_id).execute()
-    if not profile_res.data:
-        raise HTTPException(status_code=500, detail="Profilo utente non trovato.")
-    profile = profile_res.data[0]
+async def get_user_status(request: Request, auth: AuthContext = Depends(get_auth_context)):
+    user_id, profile, plan = auth.user_id, auth.profile, auth.plan
 
     # --- LOGICA AGGIORNATA PER RESTITUIRE I PERMESSI DETTAGLIATI ---
-    user_tier_name = profile.get('subscription_tier', 'free')
-    user_role = profile.get('role', 'user')
-    plan = PLANS.get("admin") if user_role == 'admin' else PLANS.get(user_tier_name, PLANS["free"])
-    ctov_res = supabase.table('ctov_profiles').select('*').eq('user_id', user_id).execute()
-    #ctov_profiles_data = [CTOVProfileResponse(**p, id=str(p['id'])) for p in ctov_res.data]
-    
-    ctov_profiles_data = []
-    for p in ctov_res.data:
-        profile_data = p.copy()  # Crea una copia per sicurezza
-        profile_data['id'] = str(profile_data['id'])  # Sovrascrive l'id con la sua versione stringa
-        ctov_profiles_data.append(CTOVProfileResponse(**profile_data))
+    ctov_profiles_data = [CTOVProfileResponse(**p) for p in await load_ctov_profiles(user_id)]
     
     return UserStatusResponse(
-        usage=UsageInfo(count=profile.get('usage_count', 0), limit=plan["shared_limit"]),
-        tier=user_tier_name if user_role != 'admin' else 'admin',
+        usage=UsageInfo(count=await get_usage_count(auth), limit=plan["shared_limit"]),
+        tier=auth.display_tier,
         validator_profiles=plan["validator"]["allowed_profiles"],
         interpreter_profiles=plan["interpreter"]["allowed_profiles"],
         compliance_access=plan["compliance_checkr"]["enabled"],
@@ -0,0 +1,33 @@
+-- Controllo e incremento atomico della quota giornaliera condivisa.
+-- Azzera il contatore al cambio di data, verifica il limite del piano e incrementa
+-- in un'unica istruzione: restituisce il nuovo conteggio, oppure -1 se il limite
+-- è già stato raggiunto. p_limit < 0 significa piano illimitato.
+create or replace function public.increment_usage_count(p_user_id text, p_limit integer, p_today date)
+returns integer
+language plpgsql
+security definer
+set search_path = public
+as $$
+declare
+    v_count integer;
+begin
+    update public.profiles
+       set usage_count = case
+               when last_used_date::date is distinct from p_today then 1
+               else coalesce(usage_count, 0) + 1
+           end,
+           last_used_date = p_today
+     where id = p_user_id
+       and (
+           p_limit < 0
+           or last_used_date::date is distinct from p_today
+           or coalesce(usage_count, 0) < p_limit
+       )
+    returning usage_count into v_count;
+
+    return coalesce(v_count, -1);
+end;
+$$;
+
+revoke all on function public.increment_usage_count(text, integer, date) from public, anon, authenticated;
+grant execute on function public.increment_usage_count(text, integer, date) to service_role;
@@ -0,0 +1,24 @@
+-- Restituisce un'unità di quota prenotata quando la chiamata AI fallisce.
+-- Agisce solo sul contatore del giorno indicato e non scende mai sotto zero;
+-- restituisce il conteggio aggiornato.
+create or replace function public.release_usage_count(p_user_id text, p_today date)
+returns integer
+language plpgsql
+security definer
+set search_path = public
+as $$
+declare
+    v_count integer;
+begin
+    update public.profiles
+       set usage_count = greatest(coalesce(usage_count, 0) - 1, 0)
+     where id = p_user_id
+       and last_used_date::date = p_today
+    returning usage_count into v_count;
+
+    return coalesce(v_count, 0);
+end;
+$$;
+
+revoke all on function public.release_usage_count(text, date) from public, anon, authenticated;
+grant execute on function public.release_usage_count(text, date) to service_role;
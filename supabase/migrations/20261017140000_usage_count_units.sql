@@ -0,0 +1,58 @@
+-- Le funzioni di quota accettano un numero di unità, così un batch di N testi
+-- prenota (e restituisce) N chiamate in un unico passaggio. p_units = 1 mantiene
+-- il comportamento delle chiamate singole.
+drop function if exists public.increment_usage_count(text, integer, date);
+drop function if exists public.release_usage_count(text, date);
+
+create or replace function public.increment_usage_count(p_user_id text, p_limit integer, p_today date, p_units integer default 1)
+returns integer
+language plpgsql
+security definer
+set search_path = public
+as $$
+declare
+    v_count integer;
+begin
+    update public.profiles
+       set usage_count = case
+               when last_used_date::date is distinct from p_today then p_units
+               else coalesce(usage_count, 0) + p_units
+           end,
+           last_used_date = p_today
+     where id = p_user_id
+       and (
+           p_limit < 0
+           or (case
+                   when last_used_date::date is distinct from p_today then 0
+                   else coalesce(usage_count, 0)
+               end) + p_units <= p_limit
+       )
+    returning usage_count into v_count;
+
+    return coalesce(v_count, -1);
+end;
+$$;
+
+create or replace function public.release_usage_count(p_user_id text, p_today date, p_units integer default 1)
+returns integer
+language plpgsql
+security definer
+set search_path = public
+as $$
+declare
+    v_count integer;
+begin
+    update public.profiles
+       set usage_count = greatest(coalesce(usage_count, 0) - p_units, 0)
+     where id = p_user_id
+       and last_used_date::date = p_today
+    returning usage_count into v_count;
+
+    return coalesce(v_count, 0);
+end;
+$$;
+
+revoke all on function public.increment_usage_count(text, integer, date, integer) from public, anon, authenticated;
+revoke all on function public.release_usage_count(text, date, integer) from public, anon, authenticated;
+grant execute on function public.increment_usage_count(text, integer, date, integer) to service_role;
+grant execute on function public.release_usage_count(text, date, integer) to service_role;
@@ -0,0 +1,21 @@
+-- updated_at sui profili CTOV: insieme all'id identifica la versione di un profilo per
+-- le cache lato applicazione (intestazioni di prompt precompilate e automa dei termini
+-- proibiti). Il trigger lo aggiorna a ogni modifica, qualunque sia il client.
+alter table public.ctov_profiles
+    add column if not exists updated_at timestamptz not null default now();
+
+create or replace function public.set_ctov_profiles_updated_at()
+returns trigger
+language plpgsql
+as $$
+begin
+    new.updated_at = now();
+    return new;
+end;
+$$;
+
+drop trigger if exists ctov_profiles_set_updated_at on public.ctov_profiles;
+create trigger ctov_profiles_set_updated_at
+    before update on public.ctov_profiles
+    for each row
+    execute function public.set_ctov_profiles_updated_at();
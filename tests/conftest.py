@@ -0,0 +1,12 @@
+# Configurazione minima per importare main.py e ai_core.py senza servizi esterni:
+# le variabili obbligatorie vengono valorizzate solo se mancano.
+import os
+import sys
+
+os.environ.setdefault("GOOGLE_API_KEY", "test")
+os.environ.setdefault("CLERK_WEBHOOK_SECRET", "whsec_MfKQ9r8GKYqrTwjUPD8ILPZIo2LaLaSw")
+os.environ.setdefault("CLERK_JWKS_URL", "http://127.0.0.1:1/jwks")
+os.environ.setdefault("SUPABASE_URL", "http://127.0.0.1:54321")
+os.environ.setdefault("SUPABASE_SERVICE_KEY", "eyJhbGciOiJIUzI1NiJ9.eyJyb2xlIjoic2VydmljZV9yb2xlIn0.x")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,46 @@
+import asyncio
+
+import pytest
+
+import ai_core
+import main
+
+
+@pytest.fixture
+def interpreter_backends(monkeypatch):
+    scored = []
+
+    async def fake_reserve_usage(auth, units=1):
+        return main.UsageReservation(auth, 1, "2026-01-01", "postgres", units)
+
+    async def fake_interpret_text(raw_text, profile_name, model_name):
+        return "interpretazione"
+
+    async def fake_quality_score(original_text, interpreted_text, profile_name, model_name):
+        scored.append(len(original_text))
+        return {"reasoning": "ok", "human_quality_score": 90}
+
+    monkeypatch.setattr(main, "reserve_usage", fake_reserve_usage)
+    monkeypatch.setattr(main, "_prepare_interpreter_request", lambda payload, auth: ({"quality_check": True}, "modello-test", 10))
+    monkeypatch.setattr(main.ai_core, "interpret_text", fake_interpret_text)
+    monkeypatch.setattr(main.ai_core, "get_interpreter_quality_score", fake_quality_score)
+    return scored
+
+
+def _interpret(text: str):
+    auth = main.AuthContext(user_id="user_1", profile={"id": "user_1"}, plan={**main.PLANS["free"], "shared_limit": 10})
+    payload = main.TextInput(text=text, profile_name=next(iter(ai_core.INTERPRETER_PROMPT_TEMPLATES)))
+    return asyncio.run(main.interpret_document.__wrapped__(request=None, payload=payload, auth=auth))
+
+
+def test_short_document_gets_quality_report(interpreter_backends):
+    response = _interpret("Un documento breve da interpretare.")
+    assert response.quality_report is not None
+    assert interpreter_backends == [len("Un documento breve da interpretare.")]
+
+
+def test_chunked_document_skips_quality_pass(interpreter_backends):
+    # Il documento passa dai chunk: il quality score non deve ricevere l'intero originale.
+    response = _interpret("x" * (ai_core.CHUNKED_INTERPRETATION_THRESHOLD + 1))
+    assert response.quality_report is None
+    assert interpreter_backends == []
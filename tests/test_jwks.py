@@ -0,0 +1,49 @@
+import asyncio
+
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from jose import jwk, jwt
+
+import main
+
+
+def _rsa_key_pair():
+    private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    private_pem = private_key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption())
+    public_pem = private_key.public_key().public_bytes(serialization.Encoding.PEM, serialization.PublicFormat.SubjectPublicKeyInfo)
+    return private_pem, jwk.construct(public_pem, "RS256").to_dict()
+
+
+def test_refresh_skips_malformed_keys():
+    private_pem, good_key = _rsa_key_pair()
+    store = main.JWKSKeyStore("http://jwks.invalid", 3600, 30)
+
+    async def fake_fetch():
+        return {"keys": [
+            {**good_key, "kid": "good", "use": "sig"},
+            {"kid": "unsupported", "kty": "XYZ", "alg": "XYZ"},
+            {"kid": "broken", "kty": "RSA", "alg": "RS256", "e": "AQAB"},
+        ]}
+    store._fetch_jwks = fake_fetch
+
+    asyncio.run(store.refresh())
+
+    assert set(store._keys) == {"good"}
+    token = jwt.encode({"sub": "user_1"}, private_pem, algorithm="RS256", headers={"kid": "good"})
+    public_key = asyncio.run(store.get_key("good"))
+    assert jwt.decode(token, public_key, algorithms=["RS256"])["sub"] == "user_1"
+
+
+def test_refresh_fails_when_no_key_is_usable():
+    store = main.JWKSKeyStore("http://jwks.invalid", 3600, 30)
+
+    async def fake_fetch():
+        return {"keys": [{"kid": "unsupported", "kty": "XYZ", "alg": "XYZ"}]}
+    store._fetch_jwks = fake_fetch
+
+    try:
+        asyncio.run(store.refresh())
+    except Exception as e:
+        assert "Nessuna chiave" in str(e)
+    else:
+        raise AssertionError("il refresh senza chiavi valide deve fallire")
@@ -0,0 +1,46 @@
+import asyncio
+import logging
+import re
+
+import pytest
+
+import ai_core
+
+CLEAN_TEXT = "Il prodotto è pronto. Lo spediamo domani. Il cliente riceve la fattura. Il supporto resta attivo."
+
+
+@pytest.fixture
+def llm_score(monkeypatch):
+    calls = []
+
+    async def fake_get_quality_score(original_text, normalized_text, profile_name, model_name):
+        calls.append(normalized_text)
+        return {"reasoning": "valutazione LLM", "human_quality_score": 70}
+
+    monkeypatch.setattr(ai_core, "get_quality_score", fake_get_quality_score)
+    return calls
+
+
+def _score():
+    return asyncio.run(ai_core.score_quality(CLEAN_TEXT, CLEAN_TEXT, "Generico", "modello-test"))
+
+
+def test_gulpease_index_stays_on_its_scale():
+    # Parole brevissime e molte frasi portano la formula grezza oltre 100.
+    signals = ai_core.local_quality_signals("A e. O i. A e.", "A e. O i. A e.")
+    indexes = [float(value) for value in re.findall(r"indice Gulpease (\d+)", signals["reasoning"])]
+    assert indexes and all(0 <= value <= 100 for value in indexes)
+
+
+def test_prescoring_is_off_by_default(llm_score):
+    assert ai_core.LOCAL_QUALITY_ENABLED is False
+    assert _score()["human_quality_score"] == 70
+    assert llm_score == [CLEAN_TEXT]
+
+
+def test_shadow_mode_logs_both_scores_and_keeps_the_llm_one(monkeypatch, llm_score, caplog):
+    monkeypatch.setattr(ai_core, "LOCAL_QUALITY_SHADOW", True)
+    with caplog.at_level(logging.INFO):
+        report = _score()
+    assert report["human_quality_score"] == 70
+    assert any("Pre-scoring in ombra" in record.message and "LLM 70" in record.message for record in caplog.records)
@@ -0,0 +1,42 @@
+import asyncio
+
+import pytest
+
+import ai_core
+
+
+@pytest.fixture
+def fast_retries(monkeypatch):
+    monkeypatch.setattr(ai_core, "RETRY_BASE_DELAY_SECONDS", 0.0)
+    monkeypatch.setattr(ai_core, "RETRY_MAX_ATTEMPTS", 4)
+    monkeypatch.setattr(ai_core, "RETRY_REQUEST_MAX_RETRIES", 3)
+
+
+def _always_transient(attempts):
+    async def failing():
+        attempts.append(1)
+        raise ConnectionError("errore transitorio")
+    return failing
+
+
+async def _chunked_calls(count, attempts):
+    results = await asyncio.gather(*(ai_core.with_retries(_always_transient(attempts), f"chunk {i}") for i in range(count)), return_exceptions=True)
+    assert all(isinstance(r, ConnectionError) for r in results)
+
+
+def test_concurrent_calls_of_one_request_share_the_budget(fast_retries):
+    attempts = []
+
+    async def request():
+        with ai_core.request_retry_budget():
+            await _chunked_calls(4, attempts)
+
+    asyncio.run(request())
+    # Un tentativo per chunk più i 3 nuovi tentativi del budget della richiesta.
+    assert len(attempts) == 4 + 3
+
+
+def test_calls_outside_a_request_keep_their_own_budget(fast_retries):
+    attempts = []
+    asyncio.run(_chunked_calls(2, attempts))
+    assert len(attempts) == 2 * 4
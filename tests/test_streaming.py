@@ -0,0 +1,78 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+import ai_core
+
+
+def _chunk(text):
+    part = SimpleNamespace(text=text)
+    return SimpleNamespace(candidates=[SimpleNamespace(content=SimpleNamespace(parts=[part]))])
+
+
+class FakeStream:
+    """Stream di chunk che, se `fail_after` è impostato, cade dopo quel numero di chunk."""
+    def __init__(self, texts, fail_after=None):
+        self.texts = texts
+        self.fail_after = fail_after
+
+    async def __aiter__(self):
+        for i, text in enumerate(self.texts):
+            if self.fail_after is not None and i == self.fail_after:
+                raise ConnectionError("stream interrotto")
+            yield _chunk(text)
+
+
+@pytest.fixture
+def fake_model(monkeypatch):
+    streams = []
+
+    class FakeModel:
+        async def generate_content_async(self, prompt, stream=False):
+            return streams.pop(0)
+
+    monkeypatch.setattr(ai_core, "get_model", lambda *args, **kwargs: FakeModel())
+    monkeypatch.setattr(ai_core, "circuit_breakers", ai_core.CircuitBreakerRegistry())
+    return streams
+
+
+async def _collect(gen):
+    return [text async for text in gen]
+
+
+def test_breaker_records_outcome_when_stream_ends(fake_model):
+    fake_model.append(FakeStream(["a", "b"]))
+    gen = ai_core._stream_generation("modello-test", None, "prompt", "chiave-ok", "strategist", cacheable=lambda text: False)
+
+    async def first_chunk_then_rest():
+        first = await gen.__anext__()
+        # Stream aperto ma non ancora concluso: nessun esito registrato.
+        assert len(ai_core.circuit_breakers.get("modello-test").outcomes) == 0
+        return [first] + await _collect(gen)
+
+    assert asyncio.run(first_chunk_then_rest()) == ["a", "b"]
+    assert list(ai_core.circuit_breakers.get("modello-test").outcomes) == [(False, False)]
+
+
+def test_stream_failing_midway_counts_as_error(fake_model):
+    fake_model.append(FakeStream(["a", "b"], fail_after=1))
+    gen = ai_core._stream_generation("modello-test", None, "prompt", "chiave-ko", "strategist", cacheable=lambda text: False)
+    with pytest.raises(ConnectionError):
+        asyncio.run(_collect(gen))
+    assert list(ai_core.circuit_breakers.get("modello-test").outcomes) == [(True, False)]
+
+
+def test_long_stream_input_uses_chunked_interpretation(monkeypatch):
+    calls = []
+
+    async def fake_long(raw_text, profile_name, model_name):
+        calls.append(len(raw_text))
+        return '{"unito": true}'
+
+    monkeypatch.setattr(ai_core, "interpret_long_text", fake_long)
+    profile = next(iter(ai_core.INTERPRETER_PROMPT_TEMPLATES))
+    text = "x" * (ai_core.CHUNKED_INTERPRETATION_THRESHOLD + 1)
+    result = asyncio.run(_collect(ai_core.stream_interpret_text(text, profile, "modello-test")))
+    assert result == ['{"unito": true}']
+    assert calls == [len(text)]
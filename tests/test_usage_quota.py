@@ -0,0 +1,106 @@
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+
+import main
+
+
+class FakeRedisCounter:
+    """Contatore con la stessa semantica di USAGE_INCREMENT_LUA; `down` simula un guasto."""
+    def __init__(self):
+        self.values = {}
+        self.down = False
+
+    async def __call__(self, keys, args):
+        if self.down:
+            raise ConnectionError("Redis non raggiungibile")
+        limit, _, initial, units = (int(a) for a in args)
+        current = self.values.setdefault(keys[0], initial)
+        if current + units > limit:
+            return -1
+        self.values[keys[0]] = current + units
+        return self.values[keys[0]]
+
+
+@pytest.fixture
+def quota_backends(monkeypatch):
+    counter = FakeRedisCounter()
+    rpc_calls = []
+
+    async def fake_run_query(query):
+        rpc_calls.append(query)
+        raise AssertionError("con Redis configurato la quota non deve passare da Postgres")
+
+    monkeypatch.setattr(main, "usage_increment_script", counter)
+    monkeypatch.setattr(main, "run_query", fake_run_query)
+    monkeypatch.setattr(main, "run_in_background", lambda coro: coro.close())
+    return counter, rpc_calls
+
+
+def _auth(shared_limit: int) -> main.AuthContext:
+    plan = {**main.PLANS["free"], "shared_limit": shared_limit}
+    return main.AuthContext(user_id="user_1", profile={"id": "user_1", "usage_count": 0, "last_used_date": None}, plan=plan)
+
+
+def test_redis_outage_fails_closed_instead_of_counting_on_postgres(quota_backends):
+    counter, rpc_calls = quota_backends
+    auth = _auth(shared_limit=3)
+
+    async def scenario():
+        granted = 0
+        for down in (False, False, True, True, False, False, False):
+            counter.down = down
+            try:
+                reservation = await main.reserve_usage(auth)
+            except HTTPException as e:
+                assert e.status_code == (503 if down else 429)
+                continue
+            assert not down
+            await reservation.commit()
+            granted += 1
+        return granted
+
+    # Le richieste durante il guasto vengono rifiutate, non contate su un secondo contatore:
+    # a fine giornata le chiamate concesse restano entro il limite.
+    assert asyncio.run(scenario()) == 3
+    assert rpc_calls == []
+
+
+def test_outage_response_asks_client_to_retry(quota_backends):
+    counter, _ = quota_backends
+    counter.down = True
+    with pytest.raises(HTTPException) as exc_info:
+        asyncio.run(main.reserve_usage(_auth(shared_limit=10)))
+    assert exc_info.value.status_code == 503
+    assert exc_info.value.headers["Retry-After"] == str(main.USAGE_BACKEND_RETRY_AFTER_SECONDS)
+
+
+def test_cancelled_ai_call_gives_the_reservation_back(monkeypatch):
+    released = []
+
+    class RecordingReservation(main.UsageReservation):
+        async def _give_back(self, units: int):
+            released.append(units)
+
+    auth = _auth(shared_limit=10)
+
+    async def fake_reserve_usage(auth, units=1):
+        return RecordingReservation(auth, 1, "2026-01-01", "redis", units)
+
+    async def cancelled_generation(text, profile_name):
+        raise asyncio.CancelledError()
+
+    monkeypatch.setattr(main, "reserve_usage", fake_reserve_usage)
+    monkeypatch.setattr(main, "_prepare_strategist_request", lambda payload, auth: 10)
+    monkeypatch.setattr(main.ai_core, "generate_strategy", cancelled_generation)
+    handler = main.create_strategy.__wrapped__
+    payload = main.TextInput(text="Un testo di prova abbastanza lungo per la validazione del modello.", profile_name="Sviluppatore di Buyer Persona")
+
+    async def scenario():
+        with pytest.raises(asyncio.CancelledError):
+            await handler(request=None, payload=payload, auth=auth)
+        await asyncio.gather(*main.background_tasks)
+
+    asyncio.run(scenario())
+    assert released == [1]